@@ -2,26 +2,174 @@
 Offer API for a remote host to run BERT classifications on the local GPU.
 Useful if you have a laptop you're running the main script on, and a server.
 
+Clients should use remote_scoring.RemoteScoringClient, which sends msgpack.
+The older JSON protocol is still accepted.
+
+Requests from concurrent clients are merged into batches by a single
+background thread, which owns the model. Run one worker process with
+several threads, so that every request shares the same model and queue.
+The backend, one of bert_inference.BACKENDS, is set with the BERT_BACKEND
+environment variable and defaults to torch.
+
 Command:
-    gunicorn --bind 0.0.0.0:8080 --workers 2 analyzer_server:app
+    BERT_BACKEND=torch gunicorn --bind 0.0.0.0:8080 --workers 1 --worker-class gthread --threads 16 analyzer_server:app
 """
+import bert_inference
+import remote_scoring
+
+import collections
+import os
+import threading
+import time
 from flask import Flask, request, jsonify
-from pysentimiento import create_analyzer
 
-analyzer = create_analyzer(task='sentiment', lang='en')
+# Largest number of texts to give the model at once. The engine sorts each
+# batch by length, so larger batches need less padding.
+MAX_BATCH_SIZE = 4096
+# Longest time to wait for more requests before running a partial batch
+MAX_WAIT_SECONDS = 0.02
+# Requests which would take the queue over this many texts get a 429
+MAX_QUEUE_SIZE = 32768
+RETRY_AFTER_SECONDS = 1
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PendingRequest:
+    def __init__(self, text):
+        self.text = text
+        self.enqueued = time.monotonic()
+        self.scores = None
+        self.error = None
+        self.done = threading.Event()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.scores
+
+
+class MicroBatcher:
+    """Merge texts from concurrent requests into batches for one engine.
+
+    A batch is run once it has max_batch_size texts, or once the oldest
+    request has waited max_wait seconds. Requests are never split, so a
+    batch can be larger than max_batch_size if a single request is."""
+    def __init__(self, engine, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.pending = collections.deque()
+        self.queued_texts = 0
+        self.condition = threading.Condition()
+        self.stats = {
+            'requests': 0,
+            'rejected': 0,
+            'batches': 0,
+            'texts': 0,
+            'busy_seconds': 0.0,
+        }
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        pending_request = PendingRequest(text)
+        with self.condition:
+            if self.queued_texts != 0 and self.queued_texts + len(text) > self.max_queue_size:
+                self.stats['rejected'] += 1
+                raise QueueFull()
+            self.pending.append(pending_request)
+            self.queued_texts += len(text)
+            self.stats['requests'] += 1
+            self.condition.notify()
+        return pending_request
+
+    def take_batch(self):
+        with self.condition:
+            while len(self.pending) == 0:
+                self.condition.wait()
+            deadline = self.pending[0].enqueued + self.max_wait
+            while self.queued_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = [self.pending.popleft()]
+            batch_size = len(batch[0].text)
+            while len(self.pending) != 0 and batch_size + len(self.pending[0].text) <= self.max_batch_size:
+                batch.append(self.pending.popleft())
+                batch_size += len(batch[-1].text)
+            self.queued_texts -= batch_size
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            text = [i for pending_request in batch for i in pending_request.text]
+            start = time.monotonic()
+            try:
+                scores = self.engine.score(text).tolist()
+            except Exception as e:
+                for pending_request in batch:
+                    pending_request.error = e
+                    pending_request.done.set()
+                continue
+            self.stats['busy_seconds'] += time.monotonic() - start
+            self.stats['batches'] += 1
+            self.stats['texts'] += len(text)
+            offset = 0
+            for pending_request in batch:
+                pending_request.scores = scores[offset:offset + len(pending_request.text)]
+                offset += len(pending_request.text)
+                pending_request.done.set()
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['queued_requests'] = len(self.pending)
+            stats['queued_texts'] = self.queued_texts
+        stats['mean_batch_size'] = stats['texts'] / stats['batches'] if stats['batches'] != 0 else 0
+        return stats
+
+
+analyzer = bert_inference.create_sentiment_analyzer()
+backend = os.environ.get('BERT_BACKEND', 'torch')
+engine = bert_inference.create_engine(analyzer, backend)
+batcher = MicroBatcher(engine)
 app = Flask(__name__)
 
 
 @app.route('/', methods=['POST'])
 def hello_world():
-    content = request.json
-    text = content['text']
-    probabilities = analyzer.predict(text)
-    # Convert probabilities of each class to sentiment score
-    scores = [
-        -5 * i.probas['NEG'] +
-        0 * i.probas['NEU'] +
-        5 * i.probas['POS']
-        for i in probabilities
-    ]
+    msgpack_request = request.content_type == remote_scoring.CONTENT_TYPE
+    if msgpack_request:
+        request_id, text = remote_scoring.decode_request(request.get_data())
+    else:
+        text = request.json['text']
+    try:
+        pending_request = batcher.submit(text)
+    except QueueFull:
+        response = jsonify({'error': 'queue full'})
+        return response, 429, {'Retry-After': str(RETRY_AFTER_SECONDS)}
+    scores = pending_request.result()
+    if msgpack_request:
+        body = remote_scoring.encode_response(request_id, text, scores)
+        return body, 200, {'Content-Type': remote_scoring.CONTENT_TYPE}
+    # Older clients send JSON, and check the text which is echoed back
     return jsonify({'scores': scores, 'text': text})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(batcher.get_stats())
+
+
+@app.route('/version', methods=['GET'])
+def version():
+    # Clients cache scores under this model and backend
+    return jsonify({'model': analyzer.model.name_or_path, 'backend': backend})
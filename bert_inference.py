@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Batched CPU inference for the pysentimiento BERT sentiment model.
+
+Besides running the PyTorch model directly, the model can be exported to
+ONNX, optionally with int8 dynamic quantization, and run with ONNX Runtime.
+Exported models are cached in MODEL_CACHE_DIR.
+
+To check that a backend agrees with analyzer.predict(), which produced the
+published score_bert values, on a sample of tweets:
+    python bert_inference.py onnx-int8 --sample 2000
+
+This module doesn't import util at load time, so that analyzer_server doesn't
+need the geographic and database dependencies."""
+import argparse
+import datasets
+import multiprocessing
+import os
+import sys
+import numpy as np
+import pandas as pd
+import torch
+from pysentimiento import create_analyzer
+from pysentimiento.preprocessing import preprocess_tweet
+
+
+# Weight given to the probability of each class, when converting the
+# class probabilities into a sentiment score between -5 and 5
+LABEL_WEIGHTS = {
+    'NEG': -5,
+    'NEU': 0,
+    'POS': 5,
+}
+
+
+def create_sentiment_analyzer():
+    return create_analyzer(task='sentiment', lang='en')
+
+
+class BertInferenceEngine:
+    """Score text using the model and tokenizer from a pysentimiento analyzer.
+
+    Texts are sorted by token length and run in fixed-size micro-batches, so
+    each batch is only padded to the length of similar texts. The class
+    probabilities are turned into a score with one matrix product per batch."""
+    def __init__(self, analyzer, batch_size=64, num_threads=None):
+        self.tokenizer = analyzer.tokenizer
+        self.model = analyzer.model.eval()
+        self.preprocessing_args = analyzer.preprocessing_args
+        # preprocess_tweet() defaults to Spanish. analyzer.predict() passes
+        # the analyzer's language, so do the same.
+        self.lang = analyzer.lang
+        self.batch_size = batch_size
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+        torch.set_num_threads(num_threads)
+        id2label = self.model.config.id2label
+        self.label_weights = torch.tensor(
+            [LABEL_WEIGHTS[id2label[i]] for i in range(len(id2label))],
+            dtype=torch.float64,
+        )
+
+    def tokenize(self, text):
+        sentences = [preprocess_tweet(sentence, lang=self.lang, **self.preprocessing_args) for sentence in text]
+        encoded = self.tokenizer(
+            sentences,
+            truncation=True,
+            max_length=self.tokenizer.model_max_length,
+        )
+        return encoded['input_ids']
+
+    def get_logits(self, batch):
+        """Run the model on one padded batch."""
+        with torch.inference_mode():
+            return self.model(**batch).logits
+
+    def score(self, text):
+        """Score a list of texts. Returns a numpy array of scores."""
+        input_ids = self.tokenize(text)
+        # Process texts in order of length, so that padding is minimal
+        order = np.argsort([len(ids) for ids in input_ids], kind='stable')
+        scores = torch.empty(len(input_ids), dtype=torch.float64)
+        for start in range(0, len(order), self.batch_size):
+            idx = order[start:start + self.batch_size]
+            batch = self.tokenizer.pad(
+                {'input_ids': [input_ids[i] for i in idx]},
+                return_tensors='pt',
+            )
+            logits = self.get_logits(batch)
+            probabilities = torch.softmax(torch.as_tensor(logits).float(), dim=1)
+            scores[torch.from_numpy(idx)] = probabilities.double() @ self.label_weights
+        return scores.numpy()
+
+
+MODEL_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'models')
+
+# Largest difference in score, on the -5..5 scale, allowed between a
+# backend and analyzer.predict()
+SCORE_TOLERANCE = 0.05
+
+
+class LogitsOnly(torch.nn.Module):
+    """Wrap a transformers model so that it returns just the logits tensor,
+    for export to ONNX."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+
+def file_exists_non_zero_size(filename):
+    return os.path.isfile(filename) and os.path.getsize(filename) > 0
+
+
+def get_onnx_model(model, tokenizer, quantize=False):
+    """Export model to ONNX, if it hasn't been already. Returns the filename."""
+    model_name = model.name_or_path.replace('/', '--')
+    filename = os.path.join(MODEL_CACHE_DIR, f'{model_name}.onnx')
+    filename_int8 = os.path.join(MODEL_CACHE_DIR, f'{model_name}.int8.onnx')
+    if not file_exists_non_zero_size(filename):
+        print(f'Exporting {model.name_or_path} to {filename}')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        example = tokenizer(['Exporting this model'], return_tensors='pt')
+        torch.onnx.export(
+            LogitsOnly(model),
+            (example['input_ids'], example['attention_mask']),
+            filename,
+            input_names=['input_ids', 'attention_mask'],
+            output_names=['logits'],
+            dynamic_axes={
+                'input_ids': {0: 'batch', 1: 'sequence'},
+                'attention_mask': {0: 'batch', 1: 'sequence'},
+                'logits': {0: 'batch'},
+            },
+            opset_version=13,
+        )
+    if not quantize:
+        return filename
+    if not file_exists_non_zero_size(filename_int8):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f'Quantizing {filename} to {filename_int8}')
+        quantize_dynamic(filename, filename_int8, weight_type=QuantType.QInt8)
+    return filename_int8
+
+
+class OnnxInferenceEngine(BertInferenceEngine):
+    """Same as BertInferenceEngine, but runs an ONNX export of the model with
+    ONNX Runtime."""
+    def __init__(self, analyzer, quantize=False, batch_size=64, num_threads=None):
+        import onnxruntime
+        super().__init__(analyzer, batch_size=batch_size, num_threads=num_threads)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            get_onnx_model(self.model, self.tokenizer, quantize),
+            options,
+            providers=['CPUExecutionProvider'],
+        )
+
+    def get_logits(self, batch):
+        inputs = {
+            'input_ids': batch['input_ids'].numpy(),
+            'attention_mask': batch['attention_mask'].numpy(),
+        }
+        return self.session.run(['logits'], inputs)[0]
+
+
+BACKENDS = ['torch', 'onnx', 'onnx-int8']
+
+
+def create_engine(analyzer, backend='torch', **kwargs):
+    if backend == 'torch':
+        return BertInferenceEngine(analyzer, **kwargs)
+    elif backend == 'onnx':
+        return OnnxInferenceEngine(analyzer, quantize=False, **kwargs)
+    elif backend == 'onnx-int8':
+        return OnnxInferenceEngine(analyzer, quantize=True, **kwargs)
+    else:
+        raise Exception(f'Unknown BERT backend {backend}')
+
+
+def reference_scores(analyzer, text):
+    """Score text with analyzer.predict(), the way BertScorer did before it
+    used an inference engine. Slow, but used as the reference for the
+    published score_bert values."""
+    datasets.set_progress_bar_enabled(False)
+    probabilities = analyzer.predict(list(text))
+    return np.array([
+        sum(LABEL_WEIGHTS[label] * p for label, p in i.probas.items())
+        for i in probabilities
+    ])
+
+
+def check_agreement(analyzer, backend, text):
+    """Score text with both analyzer.predict() and `backend`. Returns the max
+    and mean absolute difference in score."""
+    reference = reference_scores(analyzer, text)
+    candidate = create_engine(analyzer, backend).score(text)
+    difference = np.abs(reference - candidate)
+    return difference.max(), difference.mean()
+
+
+def select_sample_text(sample_size):
+    import util
+    engine = util.create_engine()
+    with engine.connect() as con:
+        text = pd.read_sql_query(
+            f'select tweet_text from tweet limit {int(sample_size)}',
+            con=con,
+        )['tweet_text'].to_list()
+    engine.dispose()
+    return text
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Check that a BERT backend agrees with analyzer.predict()'
+    )
+    parser.add_argument(
+        'backend',
+        choices=BACKENDS,
+    )
+    parser.add_argument(
+        '--sample',
+        type=int,
+        default=2000,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    text = select_sample_text(args.sample)
+    analyzer = create_sentiment_analyzer()
+    max_difference, mean_difference = check_agreement(analyzer, args.backend, text)
+    print(f'{args.backend} vs analyzer.predict on {len(text)} tweets: '
+          f'max difference {max_difference:.5f}, mean difference {mean_difference:.5f}')
+    if max_difference > SCORE_TOLERANCE:
+        print(f'Max difference is over tolerance of {SCORE_TOLERANCE}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
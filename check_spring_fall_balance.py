@@ -1,29 +1,92 @@
 #!/usr/bin/env python3
 import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import argparse
+import glob
+import os
 
 
-df = pd.read_csv("out.csv", usecols=["legal_datetime"])
-year_month = df["legal_datetime"].str[:7]
-year_month = year_month.value_counts()
-year_month = pd.DataFrame(year_month).reset_index()
-year_month = year_month.rename(columns={'legal_datetime': 'count'})
-year_month[["year", "month"]] = year_month.reset_index()['index'].str.split("-", expand=True)
-replace_dict = {
-    '02': 'S',
-    '03': 'S',
-    '04': 'S',
-    '05': 'S',
-    '10': 'F',
-    '11': 'F',
-    '12': 'F',
-}
-year_month["sf"] = year_month["month"].map(replace_dict)
-year_month = year_month[["year", "sf", "count"]]
-year_month = year_month.groupby(["year", "sf"]).sum()
-year_month = year_month['count'] / year_month.groupby('year')['count'].transform('sum') * 100
-#year_month = year_month.rename(columns={"count": "pct"})
-print("Summary of fall/spring balance for each year, in percent")
-for year, row in pd.DataFrame(year_month).unstack().iterrows():
-    spring = row['count', 'S']
-    fall = row['count', 'F']
-    print(f"In {year}, {spring:.2f}% of tweets were in spring, and {fall:.2f}% were in fall")
+def get_counts_from_csv(filename):
+    df = pd.read_csv(filename, usecols=["legal_datetime"])
+    year_month = df["legal_datetime"].str[:7]
+    year_month = year_month.value_counts()
+    year_month = pd.DataFrame(year_month).reset_index()
+    year_month = year_month.rename(columns={'legal_datetime': 'count'})
+    year_month[["year", "month"]] = year_month.reset_index()['index'].str.split("-", expand=True)
+    replace_dict = {
+        '02': 'S',
+        '03': 'S',
+        '04': 'S',
+        '05': 'S',
+        '10': 'F',
+        '11': 'F',
+        '12': 'F',
+    }
+    year_month["sf"] = year_month["month"].map(replace_dict)
+    year_month = year_month[["year", "sf", "count"]]
+    return year_month
+
+
+def get_counts_from_dataset(directory):
+    """Count rows in a partitioned export. Only the Parquet/IPC metadata
+    and the directory names are read."""
+    file_format = 'ipc' if len(glob.glob(os.path.join(directory, '**', '*.arrow'), recursive=True)) != 0 else 'parquet'
+    dataset = ds.dataset(directory, format=file_format, partitioning='hive')
+    rows = []
+    for fragment in dataset.get_fragments():
+        keys = ds.get_partition_keys(fragment.partition_expression)
+        rows.append({
+            'year': str(keys['legal_year']),
+            'sf': keys['spring_fall_indicator'],
+            'count': fragment.count_rows(),
+        })
+    return pd.DataFrame(rows, columns=['year', 'sf', 'count'])
+
+
+def get_counts_from_parquet(filename):
+    df = pq.read_table(filename, columns=['legal_year', 'spring_fall_indicator']).to_pandas()
+    df = df.rename(columns={'legal_year': 'year', 'spring_fall_indicator': 'sf'})
+    df['year'] = df['year'].astype(str)
+    return df.groupby(['year', 'sf']).size().rename('count').reset_index()
+
+
+def get_counts(filename):
+    if os.path.isdir(filename):
+        year_month = get_counts_from_dataset(filename)
+    elif filename.endswith('.parquet'):
+        year_month = get_counts_from_parquet(filename)
+    else:
+        year_month = get_counts_from_csv(filename)
+    # 'U' is neither spring nor fall
+    return year_month[year_month['sf'].isin(['S', 'F'])]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Summarize spring/fall balance of an export'
+    )
+    parser.add_argument(
+        'filename',
+        nargs='?',
+        default='out.csv',
+        help='CSV or Parquet file, or partitioned directory, from export_csv.py',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    year_month = get_counts(args.filename)
+    year_month = year_month.groupby(["year", "sf"]).sum()
+    year_month = year_month['count'] / year_month.groupby('year')['count'].transform('sum') * 100
+    #year_month = year_month.rename(columns={"count": "pct"})
+    print("Summary of fall/spring balance for each year, in percent")
+    for year, row in pd.DataFrame(year_month).unstack().iterrows():
+        spring = row['count', 'S']
+        fall = row['count', 'F']
+        print(f"In {year}, {spring:.2f}% of tweets were in spring, and {fall:.2f}% were in fall")
+
+
+if __name__ == '__main__':
+    main()
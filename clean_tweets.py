@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 import util
 import score
+import score_cache
+import ndjson
+import staging
 
 import json
+import os
 import argparse
-import itertools
+import collections
+import concurrent.futures
 import multiprocessing
 import state_boundaries
 import timezone_boundaries
+import tweet_features
 from tqdm import tqdm
 import pandas as pd
 import sqlalchemy
+from sqlalchemy.dialects import mysql
 from cachetools import cached
 
 
@@ -60,6 +67,15 @@ def create_tables(con):
                        days_since_transition double)""",
         """CREATE TABLE tweet_time_summary
                        (date_day varchar(10) UNIQUE, cnt int)""",
+        """CREATE TABLE tweet_features
+                       (tweet_id varchar(19) UNIQUE, legal_datetime datetime(6),
+                       legal_year smallint, legal_month tinyint, legal_day tinyint,
+                       legal_hour tinyint, legal_minute tinyint, legal_second tinyint,
+                       legal_day_of_week tinyint, spring_fall_indicator char(1),
+                       within_1wk_transition tinyint, within_2wk_transition tinyint,
+                       within_3wk_transition tinyint, within_4wk_transition tinyint,
+                       INDEX (legal_year, spring_fall_indicator),
+                       INDEX (legal_datetime))""",
     ]
     # Create table
     for table_sql in tables:
@@ -70,76 +86,121 @@ def create_tables(con):
             pass
 
 
-def load_nl_deliminted_json_file(filename, chunk_size):
-    """Reads a file where each line is a separate JSON object.
-    Reads the file into chunks of chunk_size long and yields
-    it lazily as an iterator."""
-    with open(filename, 'rt') as f:
-        line_num = 1
+def load_nl_deliminted_json_file_from_offset(filename, chunk_size, offset=0):
+    """Reads a file where each line is a separate JSON object, starting at
+    byte offset `offset`, in chunks of chunk_size lines. Yields (objects,
+    offset) pairs, where offset is the byte offset just past the last line
+    in objects.
+
+    A final line without a newline is treated as still being written, and
+    is left for the next run."""
+    with open(filename, 'rb') as f:
+        f.seek(offset)
         while True:
             objects = []
             for i in range(chunk_size):
-                try:
-                    # Read one additional line, parse as JSON, and add
-                    # to objects list
-                    try:
-                        objects.append(json.loads(next(f)))
-                        line_num += 1
-                    except json.decoder.JSONDecodeError as e:
-                        raise Exception(f'Error on line {line_num}') from e
-                except StopIteration:
-                    # End of file. Exit the for loop.
-                    # Still yield the objects list if we got any.
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # End of file, or a partially written line
                     break
+                try:
+                    objects.append(ndjson.loads(line))
+                except json.decoder.JSONDecodeError as e:
+                    raise Exception(f'Error at byte offset {offset} of {filename}') from e
+                offset += len(line)
             if len(objects) > 0:
-                if chunk_size == 1:
-                    yield objects[0]
-                else:
-                    yield objects
+                yield objects, offset
             else:
                 return
 
 
 def read_tweets():
-    return load_nl_deliminted_json_file('tweets.json', 10000)
-
-
-def filter_places_from_tweets(tweets, chunk_size=500):
-    place_existing = set()
+    # Tweets can be in both the Parquet staging files and tweets.json, e.g.
+    # if fetch_tweets.py was run with --format json after staging files were
+    # written. Tweets already inserted are skipped by insert_tweets().
+    if staging.staging_exists():
+        yield from staging.read_tweets()
+    if not os.path.exists('tweets.json'):
+        return
+    for tweets, offset in ndjson.read_parallel('tweets.json', project=ndjson.project_tweet):
+        if len(tweets) > 0:
+            yield tweets
+
+
+PLACES_CHECKPOINT = 'places_checkpoint.json'
+
+
+def load_places_checkpoint():
+    """Get the byte offset reached in each input file by a previous run of
+    load_places_from_file()."""
+    if not util.file_exists_non_zero_size(PLACES_CHECKPOINT):
+        return {}
+    with open(PLACES_CHECKPOINT, 'rt') as f:
+        return json.load(f)
+
+
+def save_places_checkpoint(checkpoint):
+    # Write to a temporary file and rename, so a crash can't leave a
+    # truncated checkpoint behind
+    with open(PLACES_CHECKPOINT + '.tmp', 'wt') as f:
+        json.dump(checkpoint, f)
+    os.replace(PLACES_CHECKPOINT + '.tmp', PLACES_CHECKPOINT)
+
+
+def read_places_resumable(place_existing, checkpoint, chunk_size=500,
+                          checkpoint_bytes=64 * 1024 * 1024):
+    """Read places from places.json, and from the place of each tweet. Skips
+    places in `place_existing`, and starts each file at the offset saved in
+    `checkpoint`. Yields (places, checkpoint) pairs, where the checkpoint is
+    safe to save once places are inserted."""
     partial_chunk = []
-    for tweet_chunk in tweets:
-        assert isinstance(tweet_chunk, list)
-        place_chunk = [
-            tweet['place']
-            for tweet in tweet_chunk
-            if 'place' in tweet
-        ]
-        place_chunk = [
-            place
-            for place in place_chunk
-            # This can technically include the same place twice
-            # in the same chunk, but w/e
-            if place['id'] not in place_existing
-        ]
-        place_existing.update(
-            place['id']
-            for place in place_chunk
-        )
-        partial_chunk.extend(place_chunk)
-        # If the partial chunk is big enough, emit it
-        if len(partial_chunk) > chunk_size:
-            yield partial_chunk
-            partial_chunk = []
+    filenames = ['places.json']
+    if os.path.exists('tweets.json'):
+        filenames.append('tweets.json')
+    for filename in filenames:
+        offset = checkpoint.get(filename, 0)
+        if offset > os.path.getsize(filename):
+            # File is shorter than when the checkpoint was written. It must
+            # have been replaced, so start over.
+            offset = 0
+        last_yield_offset = offset
+        for objects, offset in load_nl_deliminted_json_file_from_offset(filename, 500, offset):
+            if filename == 'tweets.json':
+                place_chunk = [tweet['place'] for tweet in objects if 'place' in tweet]
+            else:
+                place_chunk = objects
+            for place in place_chunk:
+                if place['id'] not in place_existing:
+                    place_existing.add(place['id'])
+                    partial_chunk.append(place)
+            checkpoint = {**checkpoint, filename: offset}
+            # If the partial chunk is big enough, emit it. Also emit it
+            # every so often when there are few new places, so that the
+            # checkpoint keeps moving forward.
+            if len(partial_chunk) > chunk_size or offset - last_yield_offset > checkpoint_bytes:
+                yield partial_chunk, checkpoint
+                partial_chunk = []
+                last_yield_offset = offset
+    # Read places from Parquet staging files. These are never modified once
+    # written, so the checkpoint records which files are done.
+    staged_files_done = set(checkpoint.get(staging.STAGING_DIR, []))
+    for filename in staging.get_staged_files():
+        if filename in staged_files_done:
+            continue
+        for place_chunk in staging.read_places(filename):
+            for place in place_chunk:
+                if place['id'] not in place_existing:
+                    place_existing.add(place['id'])
+                    partial_chunk.append(place)
+            if len(partial_chunk) > chunk_size:
+                yield partial_chunk, checkpoint
+                partial_chunk = []
+        staged_files_done.add(filename)
+        checkpoint = {**checkpoint, staging.STAGING_DIR: sorted(staged_files_done)}
+        yield partial_chunk, checkpoint
+        partial_chunk = []
     # Yield any leftover chunks
-    if len(partial_chunk) > 0:
-        yield partial_chunk
-
-
-def read_places():
-    places_only = load_nl_deliminted_json_file('places.json', 500)
-    tweets = load_nl_deliminted_json_file('tweets.json', 500)
-    places_from_tweets = filter_places_from_tweets(tweets)
-    return itertools.chain(places_only, places_from_tweets)
+    yield partial_chunk, checkpoint
 
 
 @cached(cache={}, key=lambda con: 0)
@@ -147,24 +208,33 @@ def get_tables(con):
     return [x[0] for x in con.execute('show tables').fetchall()]
 
 
-def insert_dataframe(df, table, pk, con):
+def insert_ignoring_duplicates(pk):
+    """Make a DataFrame.to_sql() insertion method which skips rows that
+    would duplicate a unique key already in the table.
+
+    Each chunk is sent as one multi-row INSERT ... ON DUPLICATE KEY UPDATE
+    statement. The update sets `pk` to its current value, so existing rows
+    are left alone, but unlike INSERT IGNORE other errors still raise."""
+    def insert(pd_table, con, keys, data_iter):
+        stmt = mysql.insert(pd_table.table)
+        stmt = stmt.on_duplicate_key_update({pk: stmt.table.c[pk]})
+        con.execute(stmt, [dict(zip(keys, row)) for row in data_iter])
+    return insert
+
+
+def insert_dataframe(df, table, pk, con, chunk_size=10000):
     """Insert dataframe `df` into table `table`, ignoring rows which already have a match
-    in the `pk` column. If `pk` is None, then insert all rows."""
+    in one of the table's unique keys. `pk` names a column in that key. If `pk` is None,
+    then insert all rows."""
     # Make sure the table exists
     assert table in get_tables(con)
-    if pk is not None:
-        # For each row, check if the primary key alreay exists
-        pk_list = df[pk].to_list()
-        pk_query = f"{pk} in ({', '.join(map(repr, pk_list))})"
-        num_present = pd.read_sql_query(f'select count(*) from {table} where {pk_query}', con=con).iloc[0, 0]
-        if num_present == len(df):
-            # All rows which could be inserted already have been
-            return
-        already_present = pd.read_sql_query(f'select {pk} from {table} where {pk_query}', con=con)
-        # Filter rows already present
-        df = df[~df[pk].isin(already_present[pk])]
-    if len(df) > 0:
+    if len(df) == 0:
+        return
+    if pk is None:
         df.to_sql(table, if_exists='append', index=False, con=con)
+    else:
+        df.to_sql(table, if_exists='append', index=False, con=con,
+                  chunksize=chunk_size, method=insert_ignoring_duplicates(pk))
 
 
 def insert_tweets(tweets, con):
@@ -196,8 +266,9 @@ def infer_bbox(place):
 
 @util.listify
 def geocode_places(places):
-    for place in places:
-        state = state_boundaries.geocode_place(place)
+    places = list(places)
+    states = state_boundaries.geocode_places_bulk(places)
+    for place, state in zip(places, states):
         if state is None:
             # Only include place if it geocodes somewhere
             continue
@@ -209,7 +280,15 @@ def geocode_places(places):
         yield place
 
 
+def geocode_places_chunk(chunk):
+    """Geocode places in a Pool worker, passing the checkpoint through."""
+    places, checkpoint = chunk
+    return geocode_places(places), checkpoint
+
+
 def insert_places(places, con):
+    if len(places) == 0:
+        return
     data_columns = {
         'place_id': 'id',
         'state': 'state',
@@ -226,9 +305,39 @@ def insert_places(places, con):
     insert_dataframe(places, 'place', 'place_id', con)
 
 
-def select_unscored_tweets(method, con):
-    df_generator = pd.read_sql_query(
-        f"""
+def imap_bounded(pool, func, iterable, processes):
+    """Like pool.imap(), but reads at most two items per process from
+    `iterable` ahead of the consumer.
+
+    Pool.imap() hands the iterable to a feeder thread which drains it as
+    fast as it can, so every page of a large query could end up in memory."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= 2 * processes:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def read_sql_pages(query, key, con):
+    """Run `query` one page at a time, using keyset pagination on `key`.
+
+    The query must filter on `key > :last_key`, order by `key`, and have a
+    limit. Each page is an index range scan which starts where the previous
+    page ended, so memory use is bounded by the page size, and callers can
+    start work on the first page before later pages are fetched."""
+    last_key = ''
+    while True:
+        df = pd.read_sql_query(sqlalchemy.text(query), con=con, params={'last_key': last_key})
+        if len(df) == 0:
+            return
+        yield df
+        last_key = df[key].iloc[-1]
+
+
+def select_unscored_tweets(method, con, page_size=100000):
+    query = f"""
         select t.tweet_id, t.tweet_text from
             tweet t
         left join
@@ -237,11 +346,12 @@ def select_unscored_tweets(method, con):
             t.tweet_id = s.tweet_id and
             s.type = '{method}'
         where
-            s.tweet_id is null;""",
-        con=con,
-        chunksize=100000,
-    )
-    return df_generator
+            s.tweet_id is null and
+            t.tweet_id > :last_key
+        order by
+            t.tweet_id
+        limit {page_size};"""
+    return read_sql_pages(query, 'tweet_id', con)
 
 
 def count_unscored_tweets(method, con):
@@ -261,13 +371,60 @@ def count_unscored_tweets(method, con):
     return count
 
 
+def get_missing_score_joins(methods):
+    joins = '\n'.join(f"""
+        left join
+            score s_{method}
+        on
+            t.tweet_id = s_{method}.tweet_id and
+            s_{method}.type = '{method}'""" for method in methods)
+    missing = ' or '.join(f's_{method}.tweet_id is null' for method in methods)
+    return joins, missing
+
+
+def select_tweets_missing_scores(methods, con, page_size=100000):
+    """Page through tweets which are missing a score for any of `methods`.
+    There is a missing_<method> column for each method."""
+    joins, missing = get_missing_score_joins(methods)
+    missing_columns = ', '.join(f's_{method}.tweet_id is null as missing_{method}' for method in methods)
+    query = f"""
+        select t.tweet_id, t.tweet_text, {missing_columns} from
+            tweet t
+        {joins}
+        where
+            ({missing}) and
+            t.tweet_id > :last_key
+        order by
+            t.tweet_id
+        limit {page_size};"""
+    return read_sql_pages(query, 'tweet_id', con)
+
+
+def count_tweets_missing_scores(methods, con):
+    joins, missing = get_missing_score_joins(methods)
+    count = pd.read_sql_query(
+        f"""
+        select count(*) from
+            tweet t
+        {joins}
+        where
+            {missing};""",
+        con=con,
+    ).iloc[0, 0]
+    return count
+
+
 def insert_scores(df, con):
-    insert_dataframe(df, 'score', pk=None, con=con)
+    # Primary key is (tweet_id, type)
+    insert_dataframe(df, 'score', pk='tweet_id', con=con)
 
 
-def select_tweets_without_timezones(con):
-    df_iter = pd.read_sql_query(
-        """
+def select_tweets_without_timezones(con, page_size=10000):
+    # Page through tweets in tweet_id order. This is an index range scan,
+    # rather than a filesort on place_id. Place lookups are served by the
+    # on-disk place_tz_area index, so tweets don't need to arrive grouped
+    # by place.
+    query = f"""
         select
             t.tweet_id, t.date, t.place_id, p.minx, p.miny, p.maxx, p.maxy
         from
@@ -282,16 +439,13 @@ def select_tweets_without_timezones(con):
             t.place_id = p.place_id
         where
             tz.tweet_id is null and
-            p.minx is not null
+            p.minx is not null and
+            t.tweet_id > :last_key
         order by
-            t.place_id
-        """,
-        con=con,
-        chunksize=10000,
-    )
-    for df in df_iter:
-        if len(df) > 0:
-            yield df
+            t.tweet_id
+        limit {page_size}
+        """
+    return read_sql_pages(query, 'tweet_id', con)
 
 
 def select_tweets_without_timezones_incremental(tweet_ids, con):
@@ -319,6 +473,75 @@ def insert_timezones(df, con):
     insert_dataframe(df, 'tweet_legal_tz', 'tweet_id', con)
 
 
+FEATURE_INPUT_COLUMNS = """
+            t.tweet_id, t.date,
+            tz.local_legal_time_offset_ci_point, tz.days_since_transition"""
+
+
+def select_tweets_without_features(con, page_size=100000):
+    query = f"""
+        select
+            {FEATURE_INPUT_COLUMNS}
+        from
+            tweet t
+        join
+            tweet_legal_tz tz
+        on
+            t.tweet_id = tz.tweet_id
+        left join
+            tweet_features f
+        on
+            t.tweet_id = f.tweet_id
+        where
+            f.tweet_id is null and
+            t.tweet_id > :last_key
+        order by
+            t.tweet_id
+        limit {page_size}
+        """
+    return read_sql_pages(query, 'tweet_id', con)
+
+
+def count_tweets_without_features(con):
+    count = pd.read_sql_query(
+        """
+        select count(*) from
+            tweet_legal_tz tz
+        left join
+            tweet_features f
+        on
+            tz.tweet_id = f.tweet_id
+        where
+            f.tweet_id is null;""",
+        con=con,
+    ).iloc[0, 0]
+    return count
+
+
+def select_tweets_without_features_incremental(tweet_ids, con):
+    query = f"""
+        select
+            {FEATURE_INPUT_COLUMNS}
+        from
+            tweet t
+        join
+            tweet_legal_tz tz
+        on
+            t.tweet_id = tz.tweet_id
+        where
+            t.tweet_id in ({','.join(map(repr, tweet_ids))})
+        ;
+        """
+    return pd.read_sql_query(
+        query,
+        con=con,
+    )
+
+
+def insert_features(df, con):
+    insert_dataframe(df, 'tweet_features', 'tweet_id', con)
+
+
 def load_tweets_from_file(progbar_size, con):
     print('Loading tweets')
     with tqdm(total=progbar_size) as prog:
@@ -327,13 +550,24 @@ def load_tweets_from_file(progbar_size, con):
             prog.update(len(tweets))
 
 
+def select_place_ids(con):
+    return set(pd.read_sql_query('select place_id from place', con=con)['place_id'])
+
+
 def load_places_from_file(progbar_size, con):
     print('Loading places')
+    # Skip places which are already loaded, and lines which a previous run
+    # already read
+    place_existing = select_place_ids(con)
+    checkpoint = load_places_checkpoint()
+    place_iter = read_places_resumable(place_existing, checkpoint)
     with tqdm(total=progbar_size) as prog:
-        for places in read_places():
-            places = geocode_places(places)
-            insert_places(places, con)
-            prog.update(len(places))
+        num_procs = multiprocessing.cpu_count()
+        with multiprocessing.Pool(num_procs) as p:
+            for places, checkpoint in imap_bounded(p, geocode_places_chunk, place_iter, num_procs):
+                insert_places(places, con)
+                save_places_checkpoint(checkpoint)
+                prog.update(len(places))
 
 
 def load_scores_incremental(score_df, con):
@@ -349,33 +583,107 @@ def load_scores_all(con_read, con_write):
         number_tweets = count_unscored_tweets(method, con_read)
         unscored_iter = select_unscored_tweets(method, con_read)
         print(f'Scoring tweets with {method}')
+        cache_stats = score_cache.empty_stats()
         with tqdm(total=number_tweets) as prog:
             num_processes = scorer.parallelism
             if num_processes == 1:
                 for score_df in map(scorer.score_tweet_df, unscored_iter):
                     insert_scores(score_df, con_write)
+                    score_cache.add_stats(cache_stats, score_df.attrs['score_cache'])
                     prog.update(len(score_df))
             else:
                 with multiprocessing.Pool(num_processes) as p:
-                    for score_df in p.imap(scorer.score_tweet_df, unscored_iter):
+                    for score_df in imap_bounded(p, scorer.score_tweet_df, unscored_iter, num_processes):
                         insert_scores(score_df, con_write)
+                        score_cache.add_stats(cache_stats, score_df.attrs['score_cache'])
                         prog.update(len(score_df))
+        print(score_cache.format_stats(method, cache_stats))
+
+
+# Scorers for load_scores_fused(), created once in each worker process
+fused_scorers = {}
+
+
+def init_fused_scorers(methods):
+    for method in methods:
+        fused_scorers[method] = score.get_scorer(method)
+
+
+def score_tweet_df_fused(method, tweet_df):
+    return fused_scorers[method].score_tweet_df(tweet_df)
 
 
-def load_timezones_all(con):
+def load_scores_fused(con_read, con_write):
+    """Score with every method in one pass over the tweet table.
+
+    Each page of tweets missing any score is read once. Scorers which run
+    in parallel (the lexicon scorers) share a process pool, and each gets
+    its rows split into one piece per process. Scorers with parallelism 1
+    (BERT) run on a dedicated thread, which leaves torch free to use every
+    core. All the scores for a page are written with one insert."""
+    print('Scoring tweets, all methods at once')
+    methods = score.get_all_scoring_methods()
+    scorers = {method: score.get_scorer(method) for method in methods}
+    pool_methods = [method for method in methods if scorers[method].parallelism != 1]
+    thread_methods = [method for method in methods if scorers[method].parallelism == 1]
+    num_processes = multiprocessing.cpu_count()
+    number_tweets = count_tweets_missing_scores(methods, con_read)
+    cache_stats = {method: score_cache.empty_stats() for method in methods}
+    pool_executor = concurrent.futures.ProcessPoolExecutor(
+        num_processes,
+        initializer=init_fused_scorers,
+        initargs=(pool_methods,),
+    )
+    thread_executor = concurrent.futures.ThreadPoolExecutor(1)
+    with pool_executor, thread_executor, tqdm(total=number_tweets) as prog:
+        for tweet_df in select_tweets_missing_scores(methods, con_read):
+            futures = []
+            for method in methods:
+                method_df = tweet_df.loc[tweet_df[f'missing_{method}'] == 1, ['tweet_id', 'tweet_text']]
+                if len(method_df) == 0:
+                    continue
+                if method in thread_methods:
+                    futures.append(thread_executor.submit(scorers[method].score_tweet_df, method_df))
+                else:
+                    piece_size = -(-len(method_df) // num_processes)
+                    for start in range(0, len(method_df), piece_size):
+                        piece = method_df.iloc[start:start + piece_size]
+                        futures.append(pool_executor.submit(score_tweet_df_fused, method, piece))
+            score_dfs = [future.result() for future in futures]
+            for score_df in score_dfs:
+                method = score_df['type'].iloc[0]
+                score_cache.add_stats(cache_stats[method], score_df.attrs['score_cache'])
+            insert_scores(pd.concat(score_dfs, ignore_index=True), con_write)
+            prog.update(len(tweet_df))
+    for method in methods:
+        print(score_cache.format_stats(method, cache_stats[method]))
+
+
+def load_timezones_all(con_read, con_write):
     print('Finding timezones')
-    tweet_count = util.table_row_count(con, 'tweet')
-    tz_count = util.table_row_count(con, 'tweet_legal_tz')
+    tweet_count = util.table_row_count(con_read, 'tweet')
+    tz_count = util.table_row_count(con_read, 'tweet_legal_tz')
     total = tweet_count - tz_count
-    df_iter = select_tweets_without_timezones(con)
+    df_iter = select_tweets_without_timezones(con_read)
     with tqdm(total=total) as prog:
         num_procs = multiprocessing.cpu_count()
         with multiprocessing.Pool(num_procs) as p:
-            for tz_chunk in p.imap(timezone_boundaries.get_tz_for_tweets, df_iter):
-                insert_timezones(tz_chunk, con)
+            for tz_chunk in imap_bounded(p, timezone_boundaries.get_tz_for_tweets, df_iter, num_procs):
+                insert_timezones(tz_chunk, con_write)
                 prog.update(len(tz_chunk))
 
 
+def load_features_all(con_read, con_write):
+    print('Computing tweet features')
+    total = count_tweets_without_features(con_read)
+    df_iter = select_tweets_without_features(con_read)
+    with tqdm(total=total) as prog:
+        for tweet_df in df_iter:
+            features_df = tweet_features.get_features(tweet_df)
+            insert_features(features_df, con_write)
+            prog.update(len(tweet_df))
+
+
 def update_time_summary(con):
     query = """
         select
@@ -414,10 +722,19 @@ def parse_args():
         '--enable-scores',
         action='store_true'
     )
+    parser.add_argument(
+        '--fused-scores',
+        action='store_true',
+        help='Score with every method in one pass, instead of one pass per method',
+    )
     parser.add_argument(
         '--enable-tz',
         action='store_true'
     )
+    parser.add_argument(
+        '--enable-features',
+        action='store_true'
+    )
     parser.add_argument(
         '--enable-time-summary',
         action='store_true'
@@ -445,6 +762,10 @@ def clean_tweets_incremental(tweets, places, con):
     tz_df = timezone_boundaries.get_tz_for_tweets(tz_df)
     insert_timezones(tz_df, con)
 
+    # Features
+    features_df = select_tweets_without_features_incremental(ids, con)
+    insert_features(tweet_features.get_features(features_df), con)
+
 
 def main():
     engine = util.create_engine()
@@ -458,6 +779,7 @@ def main():
         enable_places = True
         enable_scores = True
         enable_tz = True
+        enable_features = True
         enable_time_summary = True
     else:
         enable_tables = args.enable_tables
@@ -465,13 +787,18 @@ def main():
         enable_places = args.enable_places
         enable_scores = args.enable_scores
         enable_tz = args.enable_tz
+        enable_features = args.enable_features
         enable_time_summary = args.enable_time_summary
 
     with engine.connect() as con:
         if enable_tables:
             create_tables(con)
         if enable_places or enable_tweets:
-            number_tweets = util.fast_line_count('tweets.json')
+            number_tweets = 0
+            if staging.staging_exists():
+                number_tweets += staging.count_rows()
+            if os.path.exists('tweets.json'):
+                number_tweets += util.fast_line_count('tweets.json')
             number_places = int(number_tweets * 8.9e-3)  # Progbar size guess
         if enable_tweets:
             load_tweets_from_file(number_tweets, con)
@@ -479,9 +806,16 @@ def main():
             load_places_from_file(number_places, con)
         if enable_scores:
             with engine.connect() as con2:
-                load_scores_all(con2, con)
+                if args.fused_scores:
+                    load_scores_fused(con2, con)
+                else:
+                    load_scores_all(con2, con)
         if enable_tz:
-            load_timezones_all(con)
+            with engine.connect() as con2:
+                load_timezones_all(con2, con)
+        if enable_features:
+            with engine.connect() as con2:
+                load_features_all(con2, con)
         if enable_time_summary:
             update_time_summary(con)
 
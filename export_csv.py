@@ -1,94 +1,330 @@
 #!/usr/bin/env python3
+import time_features
+
 import polars as pl
-import pandas as pd
+import connectorx as cx
 import argparse
 import util
-import sqlalchemy
 import datetime
+import multiprocessing
+import os
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from tqdm import tqdm
 
 
-class DataSource:
-    def __init__(self, url):
-        self.url = url
+TWEET_QUERY = """
+        select
+            t.tweet_id, t.user_id, t.date,
+            p.latitude, p.longitude, p.state,
+            ltz.local_legal_time_offset_ci_lower as legal_time_offset_ci_lower,
+            ltz.local_legal_time_offset_ci_point as legal_time_offset_ci_point,
+            ltz.local_legal_time_offset_ci_upper as legal_time_offset_ci_upper,
+            ltz.is_dst, ltz.days_since_transition, ltz.timezone_experiences_dst,
+            ltz.most_probable_tz
+        from
+            tweet t
+        left join
+            place p
+        on
+            p.place_id = t.place_id
+        left join
+            tweet_legal_tz ltz
+        on
+            ltz.tweet_id = t.tweet_id
+        where
+            p.state is not null and
+            {tweet_id_range}
+        """
+
+# Same rows as TWEET_QUERY, with the derived columns from tweet_features.
+# Tweets without features are kept, so that scores are normalized over the
+# same rows, and are dropped later for having nulls.
+FEATURES_QUERY = """
+        select
+            t.tweet_id, t.user_id,
+            p.latitude, p.longitude, p.state,
+            ltz.local_legal_time_offset_ci_lower as legal_time_offset_ci_lower,
+            ltz.local_legal_time_offset_ci_point as legal_time_offset_ci_point,
+            ltz.local_legal_time_offset_ci_upper as legal_time_offset_ci_upper,
+            ltz.is_dst, ltz.days_since_transition, ltz.timezone_experiences_dst,
+            ltz.most_probable_tz,
+            f.legal_datetime, f.legal_year, f.legal_month, f.legal_day,
+            f.legal_hour, f.legal_minute, f.legal_second, f.legal_day_of_week,
+            f.spring_fall_indicator,
+            f.within_1wk_transition, f.within_2wk_transition,
+            f.within_3wk_transition, f.within_4wk_transition
+        from
+            tweet t
+        left join
+            place p
+        on
+            p.place_id = t.place_id
+        left join
+            tweet_legal_tz ltz
+        on
+            ltz.tweet_id = t.tweet_id
+        left join
+            tweet_features f
+        on
+            f.tweet_id = t.tweet_id
+        where
+            p.state is not null and
+            {tweet_id_range}
+        """
 
-    def read_sql(self, name, query):
-        engine = sqlalchemy.create_engine(self.url)
-        with engine.connect() as con:
-            print(f'Fetching {name}')
-            df = pl.DataFrame(pd.read_sql(query, con=con))
-        engine.dispose()
-        return df
-
-    def get_scores(self):
-        score_df = self.read_sql('scores', 'select * from score')
-        methods = score_df.select(pl.col('type').unique())['type'].to_list()
-        score_df = score_df.pivot(index='tweet_id', columns='type', values='score')
-        score_df = score_df.rename({
-            method: ('score_' + method) for method in methods
-        })
-        return score_df
-
-    def localize_time(self, time_col, offset_col):
-        one_hour_in_microseconds = 60 * 60 * 1000 * 1000
-        time_int_us = time_col.dt.epoch('us')
-        time_localized = time_int_us + (offset_col * one_hour_in_microseconds).cast(int)
-        return time_localized.cast(pl.Datetime)
-
-    def format_time(self, time_col):
-        """Expand time column into component parts, each one as an integer."""
-        col_list = [
-            time_col.dt.year().alias('legal_year'),
-            time_col.dt.month().alias('legal_month'),
-            time_col.dt.day().alias('legal_day'),
-            time_col.dt.hour().alias('legal_hour'),
-            time_col.dt.minute().alias('legal_minute'),
-            time_col.dt.second().alias('legal_second'),
-        ]
-        return col_list
-
-    def get_spring_fall(self, tweet_df):
-        replace_dict = {
-            2: 'S',
-            3: 'S',
-            4: 'S',
-            5: 'S',
-            10: 'F',
-            11: 'F',
-            12: 'F',
-        }
-        tweet_df = tweet_df.with_column(
-            self.replace(tweet_df['month_number'], replace_dict, 'U').alias('spring_fall_indicator')
+SCORE_QUERY = """
+        select
+            s.tweet_id, s.score as score_{method}
+        from
+            score s
+        where
+            s.type = '{method}' and
+            {tweet_id_range}
+        """
+
+
+# Default number of tweet_id partitions for --streaming. Peak memory is
+# about the size of one partition.
+STREAMING_PARTITIONS = 200
+
+# Mean and standard deviation of each score type, over tweets with a state.
+# Nulls are skipped, and the standard deviation uses n - 1, as in polars.
+MOMENTS_QUERY = """
+        select
+            s.type, avg(s.score) as mean, stddev_samp(s.score) as std
+        from
+            tweet t
+        join
+            place p
+        on
+            p.place_id = t.place_id
+        join
+            score s
+        on
+            s.tweet_id = t.tweet_id
+        where
+            p.state is not null
+        group by
+            s.type
+        """
+
+
+class CsvWriter:
+    def __init__(self, filename):
+        self.f = open(filename, 'wb')
+        self.has_header = True
+
+    def write(self, df):
+        df.write_csv(self.f, has_header=self.has_header)
+        self.has_header = False
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
+
+    def write(self, df):
+        table = df.to_arrow()
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.filename, table.schema, compression='zstd')
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class IpcWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
+
+    def write(self, df):
+        table = df.to_arrow()
+        if self.writer is None:
+            options = pa.ipc.IpcWriteOptions(compression='zstd')
+            self.writer = pa.ipc.new_file(self.filename, table.schema, options=options)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Columns used as directories in a partitioned export, e.g.
+# out/legal_year=2019/spring_fall_indicator=S/part-0-0.parquet
+PARTITION_COLUMNS = ['legal_year', 'spring_fall_indicator']
+
+
+class DatasetWriter:
+    """Write a Hive-partitioned dataset of Parquet or Arrow IPC files.
+
+    Readers which understand Hive partitioning (pyarrow.dataset, polars,
+    duckdb) can skip whole years or seasons, and Parquet column statistics
+    let them skip row groups."""
+    def __init__(self, directory, file_format='parquet'):
+        if os.path.exists(directory):
+            raise Exception(f'{directory} already exists, not overwriting it')
+        self.directory = directory
+        self.file_format = file_format
+        if file_format == 'parquet':
+            self.file_options = ds.ParquetFileFormat().make_write_options(compression='zstd')
+            self.extension = 'parquet'
+        elif file_format == 'ipc':
+            self.file_options = ds.IpcFileFormat().make_write_options(compression='zstd')
+            self.extension = 'arrow'
+        else:
+            raise Exception(f'Unknown dataset format {file_format}')
+        self.schema = None
+        self.part = 0
+
+    def write(self, df):
+        table = df.to_arrow()
+        if self.schema is None:
+            self.schema = table.schema
+        else:
+            table = table.cast(self.schema)
+        ds.write_dataset(
+            table,
+            self.directory,
+            format=self.file_format,
+            file_options=self.file_options,
+            partitioning=PARTITION_COLUMNS,
+            partitioning_flavor='hive',
+            basename_template=f'part-{self.part}-{{i}}.{self.extension}',
+            existing_data_behavior='overwrite_or_ignore',
         )
-        return tweet_df
+        self.part += 1
 
-    def replace(self, column, replace_dict, default_value=None):
-        # initiate the expression with `pl`
-        branch = pl
+    def close(self):
+        pass
 
-        # for every value add a `when.then`
-        for from_value, to_value in replace_dict.items():
-            branch = branch.when(column == from_value).then(to_value)
 
-        # finish with an `otherwise`
-        return branch.otherwise(pl.lit(default_value))
+writers = {
+    'csv': CsvWriter,
+    'parquet': ParquetWriter,
+    'ipc': IpcWriter,
+}
 
-    def get_transition_indicators(self, tweet_df):
-        tweet_df = tweet_df.lazy()
-        cols = [
-            (7, 'within_1wk_transition'),
-            (14, 'within_2wk_transition'),
-            (21, 'within_3wk_transition'),
-            (28, 'within_4wk_transition'),
+
+def create_writer(filename, file_format, partitioned=False):
+    if partitioned:
+        return DatasetWriter(filename, file_format)
+    return writers[file_format](filename)
+
+
+class DataSource:
+    def __init__(self, url, num_partitions=None, from_features=False):
+        self.url = url
+        # Read derived time columns from the tweet_features table, instead
+        # of computing them
+        self.from_features = from_features
+        if num_partitions is None:
+            num_partitions = multiprocessing.cpu_count()
+        self.num_partitions = num_partitions
+        self.verbose = True
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+    def read_sql(self, name, query):
+        """Read the result of a query into a DataFrame with ConnectorX.
+        If query is a list, the queries are run in parallel, and the
+        results concatenated."""
+        self.log(f'Fetching {name}')
+        return cx.read_sql(self.url, query, return_type='polars')
+
+    def get_partition_bounds(self):
+        """Split tweet_id into num_partitions ranges, each with about the
+        same number of tweets. Returns a list of (lower, upper) pairs, where
+        lower is exclusive, upper is inclusive, and None is unbounded.
+
+        tweet_id is a string, so ConnectorX can't partition on it itself."""
+        bounds_df = self.read_sql('partition bounds', f"""
+        select
+            max(tweet_id) as upper
+        from
+            (select
+                tweet_id,
+                ntile({self.num_partitions}) over (order by tweet_id) as bucket
+            from
+                tweet) t
+        group by
+            bucket
+        order by
+            upper
+        """)
+        uppers = bounds_df['upper'].to_list()
+        if len(uppers) == 0:
+            return [(None, None)]
+        lowers = [None] + uppers[:-1]
+        uppers[-1] = None
+        return list(zip(lowers, uppers))
+
+    def tweet_id_range(self, column, lower, upper):
+        conditions = ['true']
+        if lower is not None:
+            conditions.append(f"{column} > '{lower}'")
+        if upper is not None:
+            conditions.append(f"{column} <= '{upper}'")
+        return ' and '.join(conditions)
+
+    def get_methods(self):
+        methods_df = self.read_sql('scoring methods', 'select distinct type from score')
+        return sorted(methods_df['type'].to_list())
+
+    def get_tweets(self, bounds, condition='true'):
+        """Read tweets in each of the tweet_id ranges in bounds. condition
+        is extra SQL to filter by, which can refer to tweet t."""
+        query = FEATURES_QUERY if self.from_features else TWEET_QUERY
+        queries = [
+            query.format(tweet_id_range=self.tweet_id_range('t.tweet_id', lower, upper) + ' and ' + condition)
+            for lower, upper in bounds
         ]
-        for days_limit, col_name in cols:
-            tweet_df = tweet_df.with_column(
-                (pl.col('days_since_transition').abs() < days_limit).cast(pl.datatypes.Int8).alias(col_name),
+        return self.read_sql('tweets', queries)
+
+    def get_scores(self, method, bounds, condition='true'):
+        """Read scores for method, like get_tweets(). condition can refer to
+        score s."""
+        queries = [
+            SCORE_QUERY.format(
+                method=method,
+                tweet_id_range=self.tweet_id_range('s.tweet_id', lower, upper) + ' and ' + condition,
             )
+            for lower, upper in bounds
+        ]
+        return self.read_sql(f'{method} scores', queries)
+
+    def join_scores(self, tweet_df, score_dfs):
+        """Add a score_<method> column for each method, as a lazy plan of
+        left joins. Each score table only has the two columns it needs, so
+        there is no pivot of the whole score table."""
+        tweet_df = tweet_df.lazy()
+        for score_df in score_dfs:
+            tweet_df = tweet_df.join(score_df.lazy(), on='tweet_id', how='left')
         return tweet_df.collect()
 
-    def normalize_scores(self, tweet_df):
-        """z-score the score columns."""
+    def normalize_scores(self, tweet_df, moments=None):
+        """z-score the score columns. moments maps each score column to its
+        (mean, std). If not given, they are computed from tweet_df."""
         score_cols = sorted(col for col in tweet_df.columns if col.startswith('score_'))
+        if moments is not None:
+            cols = [
+                (pl.col(col) - moments[col][0]) / moments[col][1]
+                for col in score_cols
+            ]
+            return tweet_df.with_columns(cols)
         # Subtract mean
         cols = [
             pl.col(col) - pl.col(col).mean()
@@ -132,66 +368,75 @@ class DataSource:
             name = col.name
             null_count = col[0]
             if null_count != 0:
-                print(f'Column {name} contains {null_count} nulls')
+                self.log(f'Column {name} contains {null_count} nulls')
         tweet_df = tweet_df.drop_nulls()
         return tweet_df
 
     def get_data2(self):
-        tweet_df = self.read_sql('tweets', """
-        select
-            t.tweet_id, t.user_id, t.date,
-            p.latitude, p.longitude, p.state,
-            ltz.local_legal_time_offset_ci_lower as legal_time_offset_ci_lower,
-            ltz.local_legal_time_offset_ci_point as legal_time_offset_ci_point,
-            ltz.local_legal_time_offset_ci_upper as legal_time_offset_ci_upper,
-            ltz.is_dst, ltz.days_since_transition, ltz.timezone_experiences_dst,
-            ltz.most_probable_tz
-        from
-            tweet t
-        left join
-            place p
-        on
-            p.place_id = t.place_id
-        left join
-            tweet_legal_tz ltz
-        on
-            ltz.tweet_id = t.tweet_id
-        where
-            p.state is not null
-        """)
-        tweet_df = tweet_df.lazy().with_columns([
-            pl.col('date').str.strptime(pl.Datetime, '%Y-%m-%dT%H:%M:%S.000Z'),
-        ]).collect()
-        tweet_df = tweet_df.with_column(
-            self.localize_time(tweet_df['date'], tweet_df['legal_time_offset_ci_point']).alias('legal_datetime')
-        )
-        tweet_df = tweet_df.with_columns([
-            tweet_df['legal_datetime'].dt.weekday().alias('legal_day_of_week'),
-            tweet_df['legal_datetime'].dt.month().alias('month_number'),
-        ])
-        tweet_df = tweet_df.with_columns(
-            self.format_time(tweet_df['legal_datetime'])
-        )
-        # Add scores
-        score_df = self.get_scores()
-        tweet_df = tweet_df.join(score_df, on=['tweet_id'], how='left')
+        bounds = self.get_partition_bounds()
+        tweet_df = self.get_tweets(bounds)
+        score_dfs = [self.get_scores(method, bounds) for method in self.get_methods()]
+        return self.transform(tweet_df, score_dfs)
+
+    def get_score_moments(self):
+        """Get the mean and standard deviation of each score column, over
+        the same rows that get_data2() normalizes with."""
+        moments_df = self.read_sql('score moments', MOMENTS_QUERY)
+        return {
+            'score_' + method: (mean, std)
+            for method, mean, std in moments_df.rows()
+        }
 
-        # Get spring/fall indicator
-        tweet_df = self.get_spring_fall(tweet_df)
+    def iter_data(self):
+        """Yield the export one tweet_id partition at a time.
+
+        Scores are normalized using moments computed in SQL beforehand, so
+        each partition is transformed independently, and only one partition
+        is in memory at once."""
+        moments = self.get_score_moments()
+        methods = self.get_methods()
+        self.verbose = False
+        for bounds in tqdm(self.get_partition_bounds()):
+            tweet_df = self.get_tweets([bounds])
+            if len(tweet_df) == 0:
+                continue
+            score_dfs = [self.get_scores(method, [bounds]) for method in methods]
+            yield self.transform(tweet_df, score_dfs, moments)
+
+    def cast_tweet_columns(self, tweet_df):
+        """Cast columns from tweet_legal_tz to Float64. They are double in
+        MySQL, and the pandas-based export always read them as float64, but
+        ConnectorX infers the type from the driver, which can give integers."""
+        cols = [
+            pl.col(col).cast(pl.Float64)
+            for col in ['is_dst', 'days_since_transition', 'timezone_experiences_dst']
+        ]
+        return tweet_df.with_columns(cols)
+
+    def transform(self, tweet_df, score_dfs, moments=None, normalize=True):
+        """Derive the exported columns from the tweet query and the score
+        for each method. If normalize is False, the raw scores are kept."""
+        tweet_df = self.cast_tweet_columns(tweet_df)
+        if self.from_features:
+            # Time columns were already derived by clean_tweets.py
+            tweet_df = time_features.cast_features(tweet_df)
+        else:
+            tweet_df = time_features.derive_features(tweet_df)
 
-        # Get transition indicators
-        tweet_df = self.get_transition_indicators(tweet_df)
+        # Add scores
+        tweet_df = self.join_scores(tweet_df, score_dfs)
 
         # Filter 2020 data
         # print('Dropping 2020')
         # tweet_df = self.drop_2020_data(tweet_df)
 
-        # Standardize scores
-        print('Normalizing scores')
-        tweet_df = self.normalize_scores(tweet_df)
+        if normalize:
+            # Standardize scores
+            self.log('Normalizing scores')
+            tweet_df = self.normalize_scores(tweet_df, moments)
 
-        print('Rounding scores')
-        tweet_df = self.round_scores(tweet_df)
+            self.log('Rounding scores')
+            tweet_df = self.round_scores(tweet_df)
 
         # Do final formatting for output, including dropping unused cols
         # and re-ordering the columns.
@@ -199,7 +444,7 @@ class DataSource:
             'date',
             'month_number',
         ]
-        tweet_df = tweet_df.drop(drop_cols)
+        tweet_df = tweet_df.drop([col for col in drop_cols if col in tweet_df.columns])
         sentiment_cols = sorted(col for col in tweet_df.columns if col.startswith('score_'))
         col_order = [
             # Tweet info
@@ -247,11 +492,37 @@ class DataSource:
 def parse_args():
     parser = argparse.ArgumentParser(
         prog='DST data export',
-        description='Export CSV for tweets gathered so far'
+        description='Export CSV, Parquet or Arrow IPC for tweets gathered so far'
     )
     parser.add_argument(
         'filename',
     )
+    parser.add_argument(
+        '--format',
+        choices=list(writers.keys()),
+        default='csv',
+    )
+    parser.add_argument(
+        '--partitioned',
+        action='store_true',
+        help='Write a directory partitioned by legal_year and spring_fall_indicator. '
+             'Needs --format parquet or ipc',
+    )
+    parser.add_argument(
+        '--streaming',
+        action='store_true',
+        help='Export one partition at a time, instead of holding every row in memory',
+    )
+    parser.add_argument(
+        '--partitions',
+        type=int,
+        help='Number of tweet_id partitions to read',
+    )
+    parser.add_argument(
+        '--from-features',
+        action='store_true',
+        help='Read derived time columns from tweet_features (clean_tweets.py --enable-features)',
+    )
 
     return parser.parse_args()
 
@@ -259,10 +530,24 @@ def parse_args():
 def main():
     args = parse_args()
     url = str(util.create_url())
-    df = DataSource(url).get_data2()
-    # print(df)
-    print(f'{len(df)} rows written')
-    df.write_csv(args.filename)
+    num_partitions = args.partitions
+    if num_partitions is None and args.streaming:
+        num_partitions = STREAMING_PARTITIONS
+    data_source = DataSource(url, num_partitions, args.from_features)
+    # Create the writer first, so that a bad format or an existing output
+    # directory is reported before any data is read
+    writer = create_writer(args.filename, args.format, args.partitioned)
+    if args.streaming:
+        df_iter = data_source.iter_data()
+    else:
+        df_iter = [data_source.get_data2()]
+    rows = 0
+    for df in df_iter:
+        # print(df)
+        writer.write(df)
+        rows += len(df)
+    writer.close()
+    print(f'{rows} rows written')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,279 @@
+"""Fetch several intervals of tweets at once, within the API rate limits.
+
+Worker threads each fetch one interval at a time. Every request, from any
+worker, first takes a slot from a shared RateLimiter. The limiter has a
+fixed window for each limit on the full-archive search endpoint: 1 request
+per second, and 300 requests per 15 minute window. If the API still
+answers 429 Too Many Requests, e.g. because its window started before this
+process did, every worker waits until the time in the x-rate-limit-reset
+header, and the windows restart from then. Fetched pages are written by the thread which
+called FetchEngine.run(), so writing overlaps with fetching.
+
+The paginator and search method are passed in, so the engine can be run
+against fetch_stub.py instead of the API."""
+import functools
+import queue
+import threading
+import time
+import tweepy
+
+
+SEARCH_KWARGS = {
+    'query': '-is:retweet lang:en has:geo place_country:US',
+    'user_fields': ['username', 'public_metrics', 'description', 'location'],
+    'tweet_fields': ['created_at', 'geo', 'public_metrics', 'text'],
+    'place_fields': ['id', 'geo', 'name', 'full_name'],
+    'expansions': ['author_id', 'geo.place_id'],
+    'max_results': 500,
+}
+PAGE_LIMIT = 10
+
+# (requests, seconds) for search_all_tweets - see
+# https://tinyurl.com/2p868yn6
+RATE_LIMITS = [
+    (1, 1),
+    (300, 15 * 60),
+]
+# Fraction of each rate limit period added to the window
+WINDOW_MARGIN = 0.01
+# Wait this long after a 429 which doesn't say when the limit resets
+DEFAULT_RESET_SECONDS = 60
+# How often to make written tweets durable and record progress in the
+# ledger. After a crash, at most this much fetching is repeated.
+CHECKPOINT_SECONDS = 60
+
+
+class FixedWindow:
+    """Allows limit requests per window of period seconds, like the API. A
+    window starts with the first request after the previous window ended.
+
+    A token bucket which refills continuously would allow up to twice the
+    limit in the first window, and a 429 with it. Windows are made slightly
+    longer than period, so that a request which reaches the API a little
+    after it was sent still falls in the API's next window."""
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period * (1 + WINDOW_MARGIN)
+        self.reset = 0
+        self.remaining = limit
+
+    def time_until_available(self, now):
+        if now >= self.reset or self.remaining > 0:
+            return 0
+        return self.reset - now
+
+    def take(self, now):
+        if now >= self.reset:
+            self.reset = now + self.period
+            self.remaining = self.limit
+        self.remaining -= 1
+
+    def end_at(self, resume):
+        """End the current window at resume, with no requests left in it."""
+        self.reset = resume
+        self.remaining = 0
+
+
+class RateLimiter:
+    """Fixed windows for several limits, shared between threads. A request
+    needs a slot in every window."""
+    def __init__(self, limits=RATE_LIMITS):
+        self.windows = [FixedWindow(limit, period) for limit, period in limits]
+        self.lock = threading.Lock()
+        self.paused_until = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = max(window.time_until_available(now) for window in self.windows)
+                wait = max(wait, self.paused_until - now)
+                if wait <= 0:
+                    for window in self.windows:
+                        window.take(now)
+                    return
+            time.sleep(wait)
+
+    def pause_until(self, reset_time):
+        """Stop handing out slots until reset_time, in seconds since the
+        epoch. New windows start from then, in step with the API's."""
+        with self.lock:
+            resume = time.monotonic() + max(0, reset_time - time.time())
+            if resume > self.paused_until:
+                self.paused_until = resume
+                for window in self.windows:
+                    window.end_at(resume)
+
+
+def get_reset_time(response):
+    reset = response.headers.get('x-rate-limit-reset')
+    if reset is None:
+        return time.time() + DEFAULT_RESET_SECONDS
+    return int(reset)
+
+
+def rate_limited(method, rate_limiter):
+    """Wrap a tweepy Client method so that each call takes a slot from
+    rate_limiter, and retries after a 429. The wrapper keeps the method's
+    name, which tweepy.Paginator uses to choose the pagination parameter."""
+    @functools.wraps(method)
+    def inner(*args, **kwargs):
+        while True:
+            rate_limiter.acquire()
+            try:
+                return method(*args, **kwargs)
+            except tweepy.TooManyRequests as e:
+                reset_time = get_reset_time(e.response)
+                print(f'Rate limited, waiting {max(0, reset_time - time.time()):.0f}s')
+                rate_limiter.pause_until(reset_time)
+    return inner
+
+
+def parse_response(response):
+    """Get tweets, in the format written to tweets.json, and places from
+    one page of search results."""
+    user_dict = {}
+    place_dict = {}
+    for user in response.includes['users']:
+        user_dict[user.id] = user.data
+    for place in response.includes['places']:
+        place_dict[place.id] = place.data
+    places = list(place_dict.values())
+    tweets = []
+    for tweet in response.data:
+        try:
+            geo = tweet.geo
+            if geo is None:
+                print(f'warn - tweet {tweet.id} missing geo info')
+                continue
+            place = place_dict[geo['place_id']]
+        except KeyError:
+            try:
+                place_id = tweet.geo['place_id']
+            except KeyError:
+                place_id = 'UNKNOWN'
+            print(f'warn - place {place_id} not included in reply')
+            continue
+        tweets.append({
+            'user': user_dict[tweet.author_id],
+            'place': place,
+            'tweet': tweet.data,
+        })
+    return tweets, places
+
+
+class FetchEngine:
+    """Fetch intervals on several threads, and write the results on the
+    calling thread, one page at a time.
+
+    search should already be rate limited, e.g. with rate_limited(). If a
+    ledger (interval_ledger.IntervalLedger) is given, each written page is
+    recorded in it, and every checkpoint_seconds the writer and ledger
+    are checkpointed together. next_interval() should then come from the
+    ledger, so that intervals are resumed from their recorded page."""
+    def __init__(self, search, tweet_writer, workers=4, paginator=tweepy.Paginator,
+                 retries=3, retry_timeout=10, queue_size=16, ledger=None,
+                 checkpoint_seconds=CHECKPOINT_SECONDS):
+        self.search = search
+        self.tweet_writer = tweet_writer
+        self.workers = workers
+        self.paginator = paginator
+        self.retries = retries
+        self.retry_timeout = retry_timeout
+        self.results = queue.Queue(queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.ledger = ledger
+        self.checkpoint_seconds = checkpoint_seconds
+
+    def fetch_interval(self, interval):
+        """Queue each page of an interval for the writer, followed by
+        (interval, None, None, None) once the interval is finished. A
+        failed request is retried from the page after the last one
+        queued."""
+        if self.ledger is None:
+            next_token, pages = None, 0
+        else:
+            next_token, pages = self.ledger.get_progress(interval)
+        failures = 0
+        # No next_token after the first page means there are no more pages
+        while pages < PAGE_LIMIT and (pages == 0 or next_token is not None):
+            try:
+                cursor = self.paginator(self.search,
+                                        start_time=interval.start(),
+                                        end_time=interval.end(),
+                                        limit=PAGE_LIMIT - pages,
+                                        pagination_token=next_token,
+                                        **SEARCH_KWARGS)
+                for response in cursor:
+                    tweets, places = parse_response(response)
+                    next_token = response.meta.get('next_token')
+                    pages += 1
+                    self.results.put((interval, tweets, places, next_token))
+                break
+            except Exception as e:
+                failures += 1
+                if failures >= self.retries:
+                    raise
+                print(e)
+                time.sleep(self.retry_timeout)
+        self.results.put((interval, None, None, None))
+
+    def work(self, next_interval):
+        try:
+            while not self.stop.is_set():
+                interval = next_interval()
+                if interval is None:
+                    # Nothing left to fetch
+                    break
+                self.fetch_interval(interval)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    def checkpoint(self):
+        self.tweet_writer.checkpoint()
+        self.ledger.checkpoint()
+
+    def run(self, next_interval, tweets_to_fetch, pbar=None):
+        """Fetch intervals from next_interval() until at least
+        tweets_to_fetch tweets are written, or next_interval() returns
+        None. Intervals already being fetched at that point are finished
+        and written too. Returns the number of tweets written."""
+        self.stop.clear()
+        threads = [
+            threading.Thread(target=self.work, args=(next_interval,), daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        tweets_fetched = 0
+        last_checkpoint = time.monotonic()
+        try:
+            while any(thread.is_alive() for thread in threads) or not self.results.empty():
+                try:
+                    interval, tweets, places, next_token = self.results.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if tweets is None:
+                    if self.ledger is not None:
+                        self.ledger.finish(interval)
+                    continue
+                self.tweet_writer.write(tweets)
+                if self.ledger is not None:
+                    self.ledger.record_page(interval, next_token, tweets)
+                    if time.monotonic() - last_checkpoint >= self.checkpoint_seconds:
+                        self.checkpoint()
+                        last_checkpoint = time.monotonic()
+                tweets_fetched += len(tweets)
+                if pbar is not None:
+                    pbar.update(len(tweets))
+                if tweets_fetched >= tweets_to_fetch:
+                    self.stop.set()
+        finally:
+            self.stop.set()
+        if self.ledger is not None:
+            self.checkpoint()
+        if len(self.errors) != 0:
+            raise self.errors[0]
+        return tweets_fetched
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""Local stand-in for the full-archive search API, for testing
+fetch_engine.py without using quota.
+
+StubClient.search_all_tweets() takes the same arguments as the tweepy Client
+method, and returns tweepy Response objects, so it works with
+tweepy.Paginator. It enforces the rate limits with fixed windows, like the
+API, and raises tweepy.TooManyRequests with x-rate-limit-* headers when
+they are exceeded. Every request also waits for a simulated latency.
+
+Run this file to compare the concurrent engine with fetching one interval
+at a time, with all limits and latencies sped up. It then checks that the
+engine stays within a per-window limit over several windows, and that a
+fetch with an interval ledger, which crashes repeatedly, writes every tweet
+exactly once:
+
+    python fetch_stub.py --speedup 20"""
+import fetch_engine
+import interval_ledger
+from interval import Interval
+
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import requests
+import tweepy
+
+
+TWEETS_PER_SECOND = 4
+LATENCY_SECONDS = 1.5
+PLACES = [
+    {'id': f'place{i}', 'name': f'Town {i}', 'full_name': f'Town {i}, ST',
+     'geo': {'type': 'Feature', 'bbox': [-100 - i, 40, -99 - i, 41], 'properties': {}}}
+    for i in range(10)
+]
+
+
+class RateLimitWindow:
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self.reset = 0
+        self.remaining = limit
+
+    def check(self, now):
+        """Count one request. Returns False if the limit is exceeded."""
+        if now >= self.reset:
+            self.reset = now + self.period
+            self.remaining = self.limit
+        if self.remaining == 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+def too_many_requests(window):
+    response = requests.Response()
+    response.status_code = 429
+    response.reason = 'Too Many Requests'
+    response.headers['x-rate-limit-limit'] = str(window.limit)
+    response.headers['x-rate-limit-remaining'] = '0'
+    response.headers['x-rate-limit-reset'] = str(math.ceil(window.reset))
+    response._content = json.dumps({'title': 'Too Many Requests', 'status': 429}).encode('utf-8')
+    return tweepy.TooManyRequests(response)
+
+
+def parse_time(timestamp_str):
+    return datetime.datetime.fromisoformat(timestamp_str[:-1]).replace(tzinfo=datetime.timezone.utc)
+
+
+class StubClient:
+    def __init__(self, limits=fetch_engine.RATE_LIMITS, latency=LATENCY_SECONDS,
+                 tweets_per_second=TWEETS_PER_SECOND):
+        self.windows = [RateLimitWindow(limit, period) for limit, period in limits]
+        self.latency = latency
+        self.tweets_per_second = tweets_per_second
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+    def get_tweets(self, start_time, end_time):
+        """Tweets in [start_time, end_time). Each second has the same
+        number of tweets, with ids derived from the time."""
+        start = math.ceil(start_time.timestamp())
+        end = math.ceil(end_time.timestamp())
+        tweets = []
+        for second in range(start, end):
+            created_at = datetime.datetime.utcfromtimestamp(second).isoformat() + '.000Z'
+            for i in range(self.tweets_per_second):
+                tweet_id = str(second * 1000 + i)
+                tweets.append({
+                    'id': tweet_id,
+                    'text': f'Tweet {tweet_id}',
+                    'created_at': created_at,
+                    'author_id': str(second % 1000),
+                    'geo': {'place_id': PLACES[second % len(PLACES)]['id']},
+                    'public_metrics': {'retweet_count': 0, 'reply_count': 0, 'like_count': 0, 'quote_count': 0},
+                    'edit_history_tweet_ids': [tweet_id],
+                })
+        # The API returns the newest tweets first
+        tweets.reverse()
+        return tweets
+
+    def search_all_tweets(self, query, *, start_time, end_time, max_results=500, next_token=None, **kwargs):
+        with self.lock:
+            self.requests += 1
+            now = time.time()
+            for window in self.windows:
+                if not window.check(now):
+                    self.rejected += 1
+                    raise too_many_requests(window)
+        time.sleep(self.latency)
+        tweets = self.get_tweets(parse_time(start_time), parse_time(end_time))
+        offset = 0 if next_token is None else int(next_token)
+        page = tweets[offset:offset + max_results]
+        users = {}
+        places = {}
+        for tweet in page:
+            users[tweet['author_id']] = {
+                'id': tweet['author_id'],
+                'username': f'user{tweet["author_id"]}',
+                'name': f'User {tweet["author_id"]}',
+                'public_metrics': {'followers_count': 0, 'following_count': 0, 'tweet_count': 1, 'listed_count': 0},
+            }
+            place = next(place for place in PLACES if place['id'] == tweet['geo']['place_id'])
+            places[place['id']] = place
+        meta = {'result_count': len(page)}
+        if offset + max_results < len(tweets):
+            meta['next_token'] = str(offset + max_results)
+        return tweepy.Response(
+            data=[tweepy.Tweet(tweet) for tweet in page],
+            includes={
+                'users': [tweepy.User(user) for user in users.values()],
+                'places': [tweepy.Place(place) for place in places.values()],
+            },
+            errors=[],
+            meta=meta,
+        )
+
+
+class ListWriter:
+    def __init__(self):
+        self.tweets = []
+
+    def write(self, tweets):
+        self.tweets.extend(tweets)
+
+    def checkpoint(self):
+        pass
+
+
+class SimulatedCrash(Exception):
+    pass
+
+
+class CrashingWriter:
+    """Buffer tweets until a checkpoint moves them to durable. Crashes
+    after crash_after writes, losing the buffer."""
+    def __init__(self, durable, crash_after):
+        self.durable = durable
+        self.buffer = []
+        self.writes = 0
+        self.crash_after = crash_after
+
+    def write(self, tweets):
+        if self.writes == self.crash_after:
+            raise SimulatedCrash()
+        self.writes += 1
+        self.buffer.extend(tweets)
+
+    def checkpoint(self):
+        self.durable.extend(self.buffer)
+        self.buffer = []
+
+
+def get_interval():
+    start = datetime.datetime(2021, 10, 10)
+    end = datetime.datetime(2021, 12, 5)
+    duration = datetime.timedelta(seconds=300)
+    return Interval.pick_random_time_interval(start, end, duration)
+
+
+def run_sequential(client, page_delay, tweets_to_fetch):
+    """Fetch like fetch_tweets.py did before fetch_engine: one interval at
+    a time, sleeping after every page."""
+    tweets_fetched = 0
+    while tweets_fetched < tweets_to_fetch:
+        interval = get_interval()
+        cursor = tweepy.Paginator(client.search_all_tweets, start_time=interval.start(),
+                                  end_time=interval.end(), limit=fetch_engine.PAGE_LIMIT,
+                                  **fetch_engine.SEARCH_KWARGS)
+        for response in cursor:
+            tweets_fetched += len(fetch_engine.parse_response(response)[0])
+            time.sleep(page_delay)
+    return tweets_fetched
+
+
+def run_engine(client, limits, workers, tweets_to_fetch):
+    rate_limiter = fetch_engine.RateLimiter(limits)
+    search = fetch_engine.rate_limited(client.search_all_tweets, rate_limiter)
+    writer = ListWriter()
+    engine = fetch_engine.FetchEngine(search, writer, workers=workers, retry_timeout=0)
+    tweets_fetched = engine.run(get_interval, tweets_to_fetch)
+    tweet_ids = [tweet['tweet']['id'] for tweet in writer.tweets]
+    assert tweets_fetched == len(tweet_ids)
+    # Each interval is fetched in full, and none of its pages are repeated.
+    # Intervals picked at random can still overlap each other.
+    assert len(tweet_ids) % (300 * client.tweets_per_second) == 0
+    return tweets_fetched
+
+
+def check_window_limit(speedup, workers):
+    """Fetch long enough to use up several windows of a small per-window
+    limit. The engine should stay within each window without a 429."""
+    limits = [(1, 1 / speedup), (20, 60 / speedup)]
+    client = StubClient(limits, LATENCY_SECONDS / speedup)
+    run_engine(client, limits, workers, 30_000)
+    assert client.requests > 2 * 20, 'Fetch too short to fill a window'
+    assert client.rejected == 0, f'{client.rejected} requests rate limited'
+    print(f'Window check: {client.requests} requests, none rate limited')
+
+
+def check_resume(limits, latency, workers, checkpoint_seconds):
+    """Fetch a 2 hour window with a ledger, crashing at random points until
+    it is covered. Every tweet in the window should be written exactly
+    once."""
+    window_start = datetime.datetime(2021, 11, 7)
+    windows = [(window_start, window_start + datetime.timedelta(hours=2))]
+    duration = datetime.timedelta(seconds=300)
+    client = StubClient(limits, latency)
+    rate_limiter = fetch_engine.RateLimiter(limits)
+    search = fetch_engine.rate_limited(client.search_all_tweets, rate_limiter)
+    durable = []
+    crashes = 0
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, interval_ledger.LEDGER_FILENAME)
+        while True:
+            # A new ledger for each run, as if the process had restarted
+            ledger = interval_ledger.IntervalLedger(filename)
+            if ledger.get_uncovered_seconds(windows) == 0 and len(ledger.unfinished) == 0:
+                break
+            writer = CrashingWriter(durable, random.randint(1, 20))
+            engine = fetch_engine.FetchEngine(search, writer, workers=workers, retry_timeout=0,
+                                              ledger=ledger, checkpoint_seconds=checkpoint_seconds)
+            try:
+                engine.run(lambda: ledger.next_interval(windows, duration), math.inf)
+            except SimulatedCrash:
+                crashes += 1
+        runs = ledger.con.execute('select count(*) from fetch_interval').fetchone()[0]
+    tweet_ids = [tweet['tweet']['id'] for tweet in durable]
+    expected = [tweet['id'] for tweet in client.get_tweets(*[
+        start.replace(tzinfo=datetime.timezone.utc) for start in windows[0]])]
+    assert len(tweet_ids) == len(set(tweet_ids)), 'Duplicate tweets written'
+    assert set(tweet_ids) == set(expected), 'Tweets missing'
+    print(f'Resume check: {len(tweet_ids)} tweets written once each after {crashes} crashes, '
+          f'{client.requests} requests, ledger merged into {runs} runs')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare fetch_engine with sequential fetching against a stub API'
+    )
+    parser.add_argument(
+        '--speedup',
+        type=float,
+        default=20,
+        help='Divide rate limit periods and latency by this',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        '--tweets',
+        type=int,
+        default=50_000,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(0)
+    limits = [(limit, period / args.speedup) for limit, period in fetch_engine.RATE_LIMITS]
+    latency = LATENCY_SECONDS / args.speedup
+    results = {}
+    for name in ['sequential', 'engine']:
+        client = StubClient(limits, latency)
+        start = time.time()
+        if name == 'sequential':
+            tweets_fetched = run_sequential(client, 1 / args.speedup, args.tweets)
+        else:
+            tweets_fetched = run_engine(client, limits, args.workers, args.tweets)
+        duration = time.time() - start
+        results[name] = tweets_fetched / duration
+        print(f'{name}: {tweets_fetched} tweets in {duration:.1f}s, {client.requests} requests, '
+              f'{client.rejected} rate limited, {tweets_fetched / duration * args.speedup:.0f} tweets/s at full scale')
+    print(f'Speedup: {results["engine"] / results["sequential"]:.2f}x')
+    check_window_limit(args.speedup, args.workers)
+    check_resume(limits, latency, args.workers, 30 / args.speedup)
+
+
+if __name__ == '__main__':
+    main()
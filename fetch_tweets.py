@@ -5,19 +5,22 @@
 import tweepy
 import datetime
 import json
-import time
-from interval import Interval
 import util
 from tqdm import tqdm
 import pandas as pd
-import itertools
 import random
+import argparse
+import contextlib
+import staging
+import fetch_engine
+import interval_ledger
+import os
 # import clean_tweets
 
 
 config = json.load(open('config.json', 'rb'))
 bearer_token = config['bearer_token']
-client = tweepy.Client(bearer_token, wait_on_rate_limit=True)
+client = tweepy.Client(bearer_token)
 
 changeover_dates = [
     #datetime.datetime(2014, 3, 9),
@@ -40,74 +43,11 @@ changeover_dates = [
     datetime.datetime(2021, 11, 7),
 ]
 
-timer = util.AdaptiveSleepTimer()
-
-
-def retry(timeout, retries):
-    def inner(func):
-        def inner2(*args, **kwargs):
-            i = 0
-            last_exception = None
-            while i < retries:
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    print(e)
-                    time.sleep(timeout)
-                    last_exception = e
-                i += 1
-            # Ran out of retries.
-            raise last_exception
-        return inner2
-    return inner
-
-
-@retry(timeout=10, retries=3)
-def fetch_tweets(interval):
-    print(f'Fetching {interval}')
-    cursor = tweepy.Paginator(client.search_all_tweets,
-                              query='-is:retweet lang:en has:geo place_country:US',
-                              user_fields=['username', 'public_metrics', 'description', 'location'],
-                              tweet_fields=['created_at', 'geo', 'public_metrics', 'text'],
-                              place_fields=['id', 'geo', 'name', 'full_name'],
-                              expansions=['author_id', 'geo.place_id'],
-                              start_time=interval.start(),
-                              end_time=interval.end(),
-                              max_results=500, limit=10)
-    tweets = []
-    places = []
-    for response in cursor:
-        user_dict = {}
-        place_dict = {}
-        for user in response.includes['users']:
-            user_dict[user.id] = user.data
-        for place in response.includes['places']:
-            place_dict[place.id] = place.data
-        places.extend(place_dict.values())
-        for tweet in response.data:
-            try:
-                geo = tweet.geo
-                if geo is None:
-                    print(f'warn - tweet {tweet.id} missing geo info')
-                    continue
-                place = place_dict[geo['place_id']]
-            except KeyError:
-                try:
-                    place_id = tweet.geo['place_id']
-                except KeyError:
-                    place_id = 'UNKNOWN'
-                print(f'warn - place {place_id} not included in reply')
-                continue
-            tweets.append({
-                'user': user_dict[tweet.author_id],
-                'place': place,
-                'tweet': tweet.data,
-            })
-
-        # There is a 1 RPS limit on this endpoint - see
-        # https://tinyurl.com/2p868yn6
-        time.sleep(1)
-    return tweets, places
+# Requests from all fetch threads share these limits. The client raises
+# TooManyRequests instead of sleeping, so that every thread waits for the
+# reset.
+rate_limiter = fetch_engine.RateLimiter()
+search_all_tweets = fetch_engine.rate_limited(client.search_all_tweets, rate_limiter)
 
 
 def write_tweets(tweets, file_handle):
@@ -117,86 +57,164 @@ def write_tweets(tweets, file_handle):
     # print(f'wrote {len(tweets)} tweets')
 
 
-def get_interval():
-    # Pick a random DST changeover, either spring forward or fall back,
-    # create an interval spanning 28 days forward and back, and pick a
-    # random 5 minute interval within those 56 days.
-    random_transition = random.choice(changeover_dates)
-    start = random_transition - datetime.timedelta(days=28)
-    end = random_transition + datetime.timedelta(days=28)
+def get_fetch_windows():
+    # 28 days forward and back from each DST changeover, either spring
+    # forward or fall back
+    return [
+        (transition - datetime.timedelta(days=28), transition + datetime.timedelta(days=28))
+        for transition in changeover_dates
+    ]
+
+
+def get_interval(ledger):
+    # Pick a random 5 minute interval within those 56 day windows, out of
+    # the time which hasn't been fetched yet
     duration = datetime.timedelta(seconds=300)
-    return Interval.pick_random_time_interval(start, end, duration)
-
-
-def get_under_represented_days(remaining_usage):
-    # Get under represented days
-    # Get number of tweets per day
-    engine = util.create_engine()
-    with engine.connect() as con:
-        tweet_time_summary = pd.read_sql_table('tweet_time_summary', con=con)
-        tweet_time_summary = tweet_time_summary.set_index('date_day')
-    engine.dispose()
-    # Add zeros for days we were supposed to fetch but didn't
+    return ledger.next_interval(get_fetch_windows(), duration)
+
+
+def get_days_to_fetch():
     days_to_fetch = []
     for transition in changeover_dates:
         for i in range(-28, 28):
             offset = datetime.timedelta(days=i)
             days_to_fetch.append((transition + offset).strftime('%Y-%m-%d'))
-    tweet_time_summary = pd.DataFrame(index=days_to_fetch) \
-        .join(tweet_time_summary, how='left') \
-        .fillna(0) \
-        .astype(int)
-
-    # See how many tweets we could get for the days with the least amount of tweets
-    last_count = None
-    for count in itertools.count(0, 1000):
-        days_under_threshold = tweet_time_summary[tweet_time_summary['cnt'] <= count]
-        usage_required = days_under_threshold.size * count - days_under_threshold['cnt'].sum()
-        print(f'Raising {days_under_threshold.size} days to {count} requires {usage_required}')
-        if usage_required > remaining_usage:
-            break
-        last_count = count
-    assert last_count is not None, "Can't fetch any tweets, too little usage remaining"
-    # Turn the expected count of tweets into a probability distribution. Dates with counts
-    # close to the expected number will get a low probability, dates with no current tweets
-    # will get a high probability
-    tweet_time_summary = tweet_time_summary[tweet_time_summary['cnt'] <= last_count].copy()
-    tweet_time_summary['shortage'] = last_count - tweet_time_summary['cnt']
-    tweet_time_summary['probability'] = tweet_time_summary['shortage'] / tweet_time_summary['shortage'].sum()
-    tweet_fetch_probability = tweet_time_summary[['probability']]
-    return tweet_fetch_probability
-
-
-def get_interval_catchup(tweet_fetch_probability):
-    # Weighting by the probability distribution, pick a random day
-    day = tweet_fetch_probability.sample(1, weights=tweet_fetch_probability['probability']).index[0]
-    day = datetime.datetime.strptime(day, '%Y-%m-%d')
-    # Within that day, pick a five minute interval at random
-    start_of_day = day
-    end_of_day = day + datetime.timedelta(days=1)
+    return days_to_fetch
+
+
+def get_under_represented_days(ledger, target_total):
+    # Get number of tweets per day, including days we were supposed to
+    # fetch but didn't. The ledger counts tweets as they are written.
+    days_to_fetch = get_days_to_fetch()
+    counts = ledger.get_day_counts(days_to_fetch)
+    # Whatever is left of the target goes to the days with the least
+    # amount of tweets, raising them all to the same level
+    remaining = max(1, target_total - sum(counts))
+    level, shortage = interval_ledger.water_fill(counts, remaining)
+    # Turn the shortage into a probability distribution. Dates with counts
+    # close to the level will get a low probability, dates with no current
+    # tweets will get a high probability
+    tweet_fetch_probability = pd.DataFrame({'probability': shortage / shortage.sum()}, index=days_to_fetch)
+    return tweet_fetch_probability[tweet_fetch_probability['probability'] > 0]
+
+
+def get_interval_catchup(ledger, target_total):
+    tweet_fetch_probability = get_under_represented_days(ledger, target_total)
     duration = datetime.timedelta(seconds=300)
-    return Interval.pick_random_time_interval(start_of_day, end_of_day, duration)
+    while len(tweet_fetch_probability) != 0:
+        # Weighting by the probability distribution, pick a random day
+        day = tweet_fetch_probability.sample(1, weights=tweet_fetch_probability['probability']).index[0]
+        start_of_day = datetime.datetime.strptime(day, '%Y-%m-%d')
+        end_of_day = start_of_day + datetime.timedelta(days=1)
+        # Within that day, pick a five minute interval not fetched yet
+        interval = ledger.next_interval([(start_of_day, end_of_day)], duration)
+        if interval is not None:
+            return interval
+        # Every interval of that day has been fetched
+        tweet_fetch_probability = tweet_fetch_probability.drop(day)
+    return get_interval(ledger)
+
+
+class JsonTweetWriter:
+    """Append tweets to tweets.json, one JSON document per line.
+
+    Buffered writes can reach the disk before the ledger records the pages
+    they came from. So if a ledger is given, the file size is recorded in it
+    at each checkpoint, and on start the file is truncated back to the size
+    recorded last. The pages after that are fetched again."""
+    def __init__(self, filename='tweets.json', ledger=None):
+        self.filename = os.path.abspath(filename)
+        self.ledger = ledger
+        if ledger is not None:
+            self.truncate_to_checkpoint()
+        self.file_handle = open(self.filename, 'at')
+
+    def truncate_to_checkpoint(self):
+        size = os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+        offset = self.ledger.get_writer_offset(self.filename)
+        if offset is not None and offset <= size:
+            if offset < size:
+                print(f'Truncating {size - offset} bytes written after the last checkpoint')
+                os.truncate(self.filename, offset)
+        else:
+            # First run with this ledger, or the file was replaced
+            self.ledger.set_writer_offset(self.filename, size)
+            self.ledger.checkpoint()
+
+    def write(self, tweets):
+        write_tweets(tweets, self.file_handle)
+
+    def checkpoint(self):
+        self.file_handle.flush()
+        os.fsync(self.file_handle.fileno())
+        if self.ledger is not None:
+            self.ledger.set_writer_offset(self.filename, os.fstat(self.file_handle.fileno()).st_size)
+
+    def close(self):
+        self.file_handle.close()
+
+
+def get_tweet_writer(staging_format, ledger=None):
+    if staging_format == 'json':
+        return JsonTweetWriter(ledger=ledger)
+    elif staging_format == 'parquet':
+        # Staged files only appear once complete, so a crash can't leave
+        # pages behind that the ledger doesn't know about
+        return staging.StagingWriter()
+    else:
+        raise Exception(f'Unknown staging format {staging_format}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--format',
+        choices=['json', 'parquet'],
+        default='json',
+        help='Append to tweets.json, or write Parquet files to ' + staging.STAGING_DIR,
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='Number of intervals to fetch at once',
+    )
+    parser.add_argument(
+        '--catch-up',
+        action='store_true',
+        help='Fetch from the days with the fewest tweets, using the counts in the interval ledger. '
+             'The first time, these are seeded from tweet_time_summary',
+    )
+    return parser.parse_args()
 
 
 def main():
-    with open('tweets.json', 'at') as tweets_fh:
+    args = parse_args()
+    ledger = interval_ledger.IntervalLedger()
+    if args.catch_up and not ledger.has_imported_day_counts():
+        # Otherwise only tweets fetched since the ledger was created would
+        # be counted, and every other day would look empty
+        print('Seeding per-day tweet counts from tweet_time_summary')
+        ledger.import_day_counts(interval_ledger.read_time_summary())
+    with contextlib.closing(get_tweet_writer(args.format, ledger)) as tweet_writer:
         usage_start, total_usage = util.get_usage()
         usage_remaining = max(0, total_usage - usage_start)
         tweets_to_fetch = 7_637_707  # usage_remaining
         tweets_fetched = 0
-        # engine = util.create_engine()
-        #tweet_fetch_probability = get_under_represented_days(usage_remaining)
+        fetcher = fetch_engine.FetchEngine(search_all_tweets, tweet_writer, workers=args.workers, ledger=ledger)
         with tqdm(total=tweets_to_fetch) as pbar:
-            while tweets_fetched < tweets_to_fetch - 10_000:
-                #interval = get_interval_catchup(tweet_fetch_probability)
-                interval = get_interval()
-                tweets, places = fetch_tweets(interval)
-                write_tweets(tweets, tweets_fh)
-                # with engine.connect() as con:
-                #     clean_tweets.clean_tweets_incremental(tweets, places, con)
-                tweets_fetched += len(tweets)
-                pbar.update(len(tweets))
+            if args.catch_up:
+                # Spread the usage we have left over the days with the
+                # fewest tweets. This is re-balanced after every page.
+                target_total = sum(ledger.get_day_counts(get_days_to_fetch())) + usage_remaining
+                next_interval = lambda: get_interval_catchup(ledger, target_total)
+            else:
+                next_interval = lambda: get_interval(ledger)
+            tweets_fetched = fetcher.run(next_interval, tweets_to_fetch - 10_000, pbar)
         print(f'Fetched {tweets_fetched} in total')
+        uncovered = ledger.get_uncovered_seconds(get_fetch_windows())
+        print(f'{uncovered / 86400:.1f} days not fetched yet')
+        ledger.close()
         usage_end, total_usage = util.get_usage()
         print(f'Usage consumed: {usage_end - usage_start}, '
               f'currently {usage_end} / {total_usage}')
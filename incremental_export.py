@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""Incremental export, which only reads tweets that haven't been exported
+before.
+
+    python incremental_export.py update export_dir
+    python incremental_export.py standardize export_dir out.parquet --format parquet
+
+`update` appends the raw, unnormalized rows for newly complete tweets to
+export_dir as one Parquet file per run. It records the exported tweet_ids
+in the tweet_export table. It also keeps the running count, mean and sum
+of squared deviations of each score column in export_dir/export_state.json.
+
+`standardize` z-scores every raw file using those moments, and writes the
+result in any format export_csv.py supports, without reading the database.
+
+A tweet is exported once it has a state, a timezone and every score. A tweet
+which is scored after a run is picked up by a later run. The score means and
+standard deviations are over exported tweets only. The full export also
+includes tweets without a timezone in them.
+
+Only new tweets are exported. Once a tweet is exported, later changes to it
+are not: a re-scored tweet, a new scoring method, or a recomputed
+tweet_legal_tz row. clean_tweets.py never overwrites scores or timezones, so
+this only happens if rows are deleted and recomputed, or a method is added.
+In that case, start over with a new export directory. `update` refuses to
+run if the set of scoring methods has changed, and `standardize` refuses to
+combine part files with different score columns."""
+import util
+import export_csv
+
+import argparse
+import json
+import math
+import os
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy
+from tqdm import tqdm
+
+
+STATE_FILENAME = 'export_state.json'
+
+NEW_TWEET_CONDITION = """
+            ltz.tweet_id is not null and
+            not exists (select 1 from tweet_export e where e.tweet_id = t.tweet_id)"""
+
+NEW_SCORE_CONDITION = """
+            not exists (select 1 from tweet_export e where e.tweet_id = s.tweet_id)"""
+
+
+def create_export_table(con):
+    con.execute(sqlalchemy.text("""
+        create table if not exists tweet_export
+            (tweet_id varchar(19), export_run int,
+            primary key (tweet_id))"""))
+
+
+def load_state(directory):
+    filename = os.path.join(directory, STATE_FILENAME)
+    if not os.path.exists(filename):
+        # methods is set by the first run
+        return {'runs': 0, 'methods': None, 'moments': {}}
+    with open(filename) as f:
+        state = json.load(f)
+    return state
+
+
+def save_state(directory, state):
+    filename = os.path.join(directory, STATE_FILENAME)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(filename + '.tmp', filename)
+
+
+def get_part_filename(directory, run):
+    return os.path.join(directory, f'part-{run:05d}.parquet')
+
+
+def get_part_filenames(directory, runs):
+    # A run which found no new tweets doesn't write a file
+    filenames = [get_part_filename(directory, run) for run in range(runs)]
+    return [filename for filename in filenames if os.path.exists(filename)]
+
+
+def add_moments(moments, tweet_df):
+    """Merge the count, mean and sum of squared deviations (m2) of each
+    score column in tweet_df into moments, with Chan et al.'s parallel
+    update. Unlike a sum of squares, this doesn't lose precision to
+    cancellation when the variance is small next to the mean."""
+    score_cols = sorted(col for col in tweet_df.columns if col.startswith('score_'))
+    for col in score_cols:
+        column = tweet_df[col].drop_nulls()
+        count_b = len(column)
+        if count_b == 0:
+            continue
+        mean_b = column.mean()
+        deviation = column - mean_b
+        m2_b = (deviation * deviation).sum()
+        col_moments = moments.setdefault(col, {'count': 0, 'mean': 0.0, 'm2': 0.0})
+        count_a = col_moments['count']
+        count = count_a + count_b
+        delta = mean_b - col_moments['mean']
+        col_moments['mean'] += delta * count_b / count
+        col_moments['m2'] += m2_b + delta * delta * count_a * count_b / count
+        col_moments['count'] = count
+    return moments
+
+
+def get_moments(moments):
+    """Get (mean, std) for each score column from running moments. The
+    standard deviation uses n - 1, as in polars."""
+    return {
+        col: (col_moments['mean'], math.sqrt(max(col_moments['m2'], 0.0) / (col_moments['count'] - 1)))
+        for col, col_moments in moments.items()
+    }
+
+
+def mark_exported(tweet_ids, run, con):
+    for tweet_id_chunk in util.chunks(tweet_ids, 10000):
+        con.execute(
+            sqlalchemy.text('insert into tweet_export (tweet_id, export_run) values (:tweet_id, :export_run)'),
+            [{'tweet_id': tweet_id, 'export_run': run} for tweet_id in tweet_id_chunk],
+        )
+
+
+def update(data_source, directory):
+    os.makedirs(directory, exist_ok=True)
+    state = load_state(directory)
+    run = state['runs']
+    moments = state['moments']
+    filename = get_part_filename(directory, run)
+    engine = sqlalchemy.create_engine(data_source.url)
+    with engine.connect() as con:
+        create_export_table(con)
+        # Undo any run which didn't finish. The state file is only saved
+        # once a run is complete.
+        con.execute(sqlalchemy.text('delete from tweet_export where export_run >= :run'), {'run': run})
+        if os.path.exists(filename):
+            os.remove(filename)
+        methods = data_source.get_methods()
+        if state['methods'] is None:
+            state['methods'] = methods
+        if state['methods'] != methods:
+            raise Exception(f'Scoring methods changed from {state["methods"]} to {methods}. '
+                            f'Tweets exported before have no new scores, so start a new export directory.')
+        writer = export_csv.ParquetWriter(filename)
+        rows = 0
+        data_source.verbose = False
+        for bounds in tqdm(data_source.get_partition_bounds()):
+            tweet_df = data_source.get_tweets([bounds], NEW_TWEET_CONDITION)
+            if len(tweet_df) == 0:
+                continue
+            score_dfs = [data_source.get_scores(method, [bounds], NEW_SCORE_CONDITION) for method in methods]
+            # Rows missing a score are dropped, and are exported by a
+            # later run
+            tweet_df = data_source.transform(tweet_df, score_dfs, normalize=False)
+            if len(tweet_df) == 0:
+                continue
+            writer.write(tweet_df)
+            add_moments(moments, tweet_df)
+            mark_exported(tweet_df['tweet_id'].to_list(), run, con)
+            rows += len(tweet_df)
+        writer.close()
+    engine.dispose()
+    state['runs'] = run + 1
+    state['moments'] = moments
+    save_state(directory, state)
+    print(f'{rows} new rows exported')
+
+
+def check_score_columns(part_filenames):
+    """Raise an exception if the part files don't all have the same score
+    columns, e.g. because a scoring method was added between runs."""
+    score_cols = {}
+    for part_filename in part_filenames:
+        schema = pq.read_schema(part_filename)
+        score_cols[part_filename] = sorted(name for name in schema.names if name.startswith('score_'))
+    if len(set(map(tuple, score_cols.values()))) > 1:
+        raise Exception(f'Part files have different score columns: {score_cols}')
+
+
+def standardize(directory, filename, file_format, partitioned=False, batch_size=1000000):
+    state = load_state(directory)
+    moments = get_moments(state['moments'])
+    data_source = export_csv.DataSource(None)
+    writer = export_csv.create_writer(filename, file_format, partitioned)
+    rows = 0
+    part_filenames = get_part_filenames(directory, state['runs'])
+    check_score_columns(part_filenames)
+    for part_filename in part_filenames:
+        for batch in pq.ParquetFile(part_filename).iter_batches(batch_size=batch_size):
+            tweet_df = pl.from_arrow(pa.Table.from_batches([batch]))
+            tweet_df = data_source.normalize_scores(tweet_df, moments)
+            tweet_df = data_source.round_scores(tweet_df)
+            writer.write(tweet_df)
+            rows += len(tweet_df)
+    writer.close()
+    print(f'{rows} rows written')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Incremental export of tweets gathered so far'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    update_parser = subparsers.add_parser(
+        'update',
+        help='Export tweets which are new since the last update',
+    )
+    update_parser.add_argument(
+        'directory',
+    )
+    update_parser.add_argument(
+        '--partitions',
+        type=int,
+        default=export_csv.STREAMING_PARTITIONS,
+    )
+    standardize_parser = subparsers.add_parser(
+        'standardize',
+        help='Write the normalized export from the raw rows and running moments',
+    )
+    standardize_parser.add_argument(
+        'directory',
+    )
+    standardize_parser.add_argument(
+        'filename',
+    )
+    standardize_parser.add_argument(
+        '--format',
+        choices=list(export_csv.writers.keys()),
+        default='csv',
+    )
+    standardize_parser.add_argument(
+        '--partitioned',
+        action='store_true',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'update':
+        url = str(util.create_url())
+        update(export_csv.DataSource(url, args.partitions), args.directory)
+    elif args.command == 'standardize':
+        standardize(args.directory, args.filename, args.format, args.partitioned)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""Ledger of the time intervals fetch_tweets.py has fetched, or is fetching.
+
+Each row of fetch_interval is a run of time [start, end), in seconds since
+the epoch. A run is either 'done', or 'fetching' with the next_token and
+number of pages of it already written. Adjacent done runs are merged, so
+the table stays small.
+
+New intervals are only sampled from time that no run covers, so quota is
+not spent on tweets we already have. Page progress is only recorded at a
+checkpoint, after the tweet writer has made the pages before it durable.
+After a crash, the intervals that were being fetched are resumed from the
+last checkpointed page. A writer which appends to a file, like
+fetch_tweets.JsonTweetWriter, also records its file size at each
+checkpoint, and truncates the file back to it on restart. Pages written
+after the last checkpoint are then fetched and written again exactly once.
+
+The ledger also keeps the number of tweets written for each UTC day, in
+day_coverage. The counts are kept in memory and updated as pages are
+written, so water_fill() can balance tweets across days without reading
+the tweet table. The first fetch_tweets.py --catch-up seeds the counts from
+tweet_time_summary, so tweets fetched before the ledger existed are
+included. The ledger records that the import happened, so an empty summary
+isn't imported again on every run. To replace the counts later, run
+clean_tweets.py --enable-time-summary, then:
+
+    python interval_ledger.py import-summary"""
+import util
+from interval import Interval
+
+import argparse
+import calendar
+import collections
+import datetime
+import numpy as np
+import pandas as pd
+import random
+import sqlite3
+import threading
+
+
+LEDGER_FILENAME = 'interval_ledger.db'
+
+
+def to_seconds(dt):
+    """Seconds since the epoch for a naive UTC datetime."""
+    return calendar.timegm(dt.utctimetuple())
+
+
+def from_seconds(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds)
+
+
+def water_fill(counts, budget):
+    """Find the level which raising every count below it up to it would
+    use exactly budget tweets. Returns the level, and how many tweets each
+    count is short of it.
+
+    With counts sorted, if the k lowest are raised the level is
+    (budget + sum of those k) / k. The answer is the smallest k where that
+    level doesn't reach the next count."""
+    counts = np.asarray(counts, dtype=np.float64)
+    assert len(counts) != 0
+    assert budget >= 0
+    sorted_counts = np.sort(counts)
+    k = np.arange(1, len(counts) + 1)
+    levels = (budget + np.cumsum(sorted_counts)) / k
+    fits = np.append(levels[:-1] <= sorted_counts[1:], True)
+    level = levels[np.argmax(fits)]
+    return level, np.maximum(0, level - counts)
+
+
+class IntervalLedger:
+    """Thread safe. Only one process should fetch with a ledger at a time,
+    since intervals left 'fetching' are assumed to be from a crashed run."""
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = util.script_relative(LEDGER_FILENAME)
+        self.con = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.con.execute('pragma journal_mode=wal')
+        self.con.execute("""
+            create table if not exists fetch_interval
+                (start integer primary key, end integer, status text,
+                next_token text, pages integer)""")
+        self.con.execute("""
+            create table if not exists day_coverage
+                (day text primary key, tweets integer)""")
+        self.con.execute("""
+            create table if not exists day_coverage_import
+                (imported_at text)""")
+        self.con.execute("""
+            create table if not exists writer_offset
+                (filename text primary key, offset integer)""")
+        self.con.commit()
+        self.lock = threading.Lock()
+        # (next_token, pages) for every interval handed out by this ledger
+        self.progress = {}
+        # Progress which isn't durable yet
+        self.pending = {}
+        self.finished = set()
+        self.day_counts = collections.Counter(dict(self.con.execute('select day, tweets from day_coverage')))
+        self.pending_day_counts = collections.Counter()
+        self.pending_writer_offsets = {}
+        unfinished = self.con.execute("""
+            select start, end, next_token, pages from fetch_interval
+            where status = 'fetching' order by start""").fetchall()
+        self.unfinished = collections.deque()
+        for start, end, next_token, pages in unfinished:
+            self.progress[start] = (next_token, pages)
+            self.unfinished.append(Interval(from_seconds(start), from_seconds(end)))
+        if len(unfinished) != 0:
+            print(f'Resuming {len(unfinished)} intervals from an earlier run')
+
+    def get_gaps(self, start, end):
+        """Runs of time within [start, end) not covered by the ledger."""
+        rows = self.con.execute("""
+            select start, end from fetch_interval
+            where end > ? and start < ? order by start""", (start, end)).fetchall()
+        gaps = []
+        position = start
+        for run_start, run_end in rows:
+            if run_start > position:
+                gaps.append((position, run_start))
+            position = max(position, run_end)
+        if position < end:
+            gaps.append((position, end))
+        return gaps
+
+    def get_uncovered_seconds(self, windows):
+        with self.lock:
+            return sum(
+                gap_end - gap_start
+                for window_start, window_end in windows
+                for gap_start, gap_end in self.get_gaps(to_seconds(window_start), to_seconds(window_end))
+            )
+
+    def claim(self, start, end):
+        self.con.execute(
+            "insert into fetch_interval values (?, ?, 'fetching', null, 0)",
+            (start, end),
+        )
+        self.con.commit()
+        self.progress[start] = (None, 0)
+        return Interval(from_seconds(start), from_seconds(end))
+
+    def next_interval(self, windows, duration):
+        """Resume an unfinished interval, or claim a random interval of
+        uncovered time within windows, a list of (start, end) datetimes.
+        Every uncovered second is equally likely to be picked. An interval
+        is shorter than duration if it fills a smaller gap. Returns None
+        once the windows are fully covered."""
+        with self.lock:
+            if len(self.unfinished) != 0:
+                return self.unfinished.popleft()
+            gaps = [
+                gap
+                for window_start, window_end in windows
+                for gap in self.get_gaps(to_seconds(window_start), to_seconds(window_end))
+            ]
+            total = sum(gap_end - gap_start for gap_start, gap_end in gaps)
+            if total == 0:
+                return None
+            position = random.randrange(total)
+            for gap_start, gap_end in gaps:
+                if position < gap_end - gap_start:
+                    break
+                position -= gap_end - gap_start
+            length = min(int(duration.total_seconds()), gap_end - gap_start)
+            start = random.randint(gap_start, gap_end - length)
+            return self.claim(start, start + length)
+
+    def get_progress(self, interval):
+        """Get (next_token, pages) to continue fetching an interval from."""
+        with self.lock:
+            return self.progress[to_seconds(interval.start_time)]
+
+    def record_page(self, interval, next_token, tweets):
+        """Note that a page of tweets has been written. It is saved at the
+        next checkpoint."""
+        # Days are in UTC, like tweet_time_summary
+        days = collections.Counter(tweet['tweet']['created_at'][:10] for tweet in tweets)
+        with self.lock:
+            start = to_seconds(interval.start_time)
+            previous_token, pages = self.progress[start]
+            self.progress[start] = (next_token, pages + 1)
+            self.pending[start] = self.progress[start]
+            self.day_counts.update(days)
+            self.pending_day_counts.update(days)
+
+    def get_day_counts(self, days):
+        with self.lock:
+            return [self.day_counts[day] for day in days]
+
+    def has_imported_day_counts(self):
+        """Whether import_day_counts() has ever been called on this ledger."""
+        with self.lock:
+            return self.con.execute('select count(*) from day_coverage_import').fetchone()[0] != 0
+
+    def import_day_counts(self, day_counts):
+        """Replace the tweet count of every day."""
+        with self.lock:
+            self.con.execute('delete from day_coverage')
+            self.con.executemany('insert into day_coverage values (?, ?)', day_counts.items())
+            self.con.execute('insert into day_coverage_import values (?)',
+                             (datetime.datetime.utcnow().isoformat(),))
+            self.con.commit()
+            self.day_counts = collections.Counter(day_counts)
+            self.pending_day_counts = collections.Counter()
+
+    def get_writer_offset(self, filename):
+        """Get the size filename had at the last checkpoint, or None."""
+        with self.lock:
+            row = self.con.execute(
+                'select offset from writer_offset where filename = ?', (filename,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_writer_offset(self, filename, offset):
+        """Note the size of a file the tweet writer has made durable. It is
+        saved at the next checkpoint, along with the pages written."""
+        with self.lock:
+            self.pending_writer_offsets[filename] = offset
+
+    def finish(self, interval):
+        with self.lock:
+            start = to_seconds(interval.start_time)
+            self.finished.add(start)
+            self.pending.pop(start, None)
+
+    def mark_done(self, start):
+        end, = self.con.execute('select end from fetch_interval where start = ?', (start,)).fetchone()
+        # Merge with done runs which end where this one starts, or start
+        # where this one ends
+        left = self.con.execute(
+            "select start from fetch_interval where end = ? and status = 'done'", (start,)).fetchone()
+        right = self.con.execute(
+            "select end from fetch_interval where start = ? and status = 'done'", (end,)).fetchone()
+        merged_start = start
+        merged_end = end
+        self.con.execute('delete from fetch_interval where start = ?', (start,))
+        if left is not None:
+            merged_start = left[0]
+            self.con.execute('delete from fetch_interval where start = ?', (merged_start,))
+        if right is not None:
+            merged_end = right[0]
+            self.con.execute('delete from fetch_interval where start = ?', (end,))
+        self.con.execute(
+            "insert into fetch_interval values (?, ?, 'done', null, null)",
+            (merged_start, merged_end),
+        )
+
+    def checkpoint(self):
+        """Save progress. Call once everything written so far is durable."""
+        with self.lock:
+            for start, (next_token, pages) in self.pending.items():
+                self.con.execute(
+                    'update fetch_interval set next_token = ?, pages = ? where start = ?',
+                    (next_token, pages, start),
+                )
+            for start in self.finished:
+                self.mark_done(start)
+            self.con.executemany("""
+                insert into day_coverage values (?, ?)
+                on conflict (day) do update set tweets = tweets + excluded.tweets""",
+                self.pending_day_counts.items(),
+            )
+            self.con.executemany(
+                'insert or replace into writer_offset values (?, ?)',
+                self.pending_writer_offsets.items(),
+            )
+            self.con.commit()
+            self.pending = {}
+            self.finished = set()
+            self.pending_day_counts = collections.Counter()
+            self.pending_writer_offsets = {}
+
+    def close(self):
+        self.con.close()
+
+
+def read_time_summary():
+    """Get the number of tweets for each day from tweet_time_summary."""
+    engine = util.create_engine()
+    with engine.connect() as con:
+        tweet_time_summary = pd.read_sql_table('tweet_time_summary', con=con)
+    engine.dispose()
+    return dict(zip(tweet_time_summary['date_day'], tweet_time_summary['cnt'].astype(int)))
+
+
+def import_summary():
+    day_counts = read_time_summary()
+    ledger = IntervalLedger()
+    ledger.import_day_counts(day_counts)
+    ledger.close()
+    print(f'Imported counts for {len(day_counts)} days')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Manage the ledger of fetched intervals'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser(
+        'import-summary',
+        help='Replace the per-day tweet counts with tweet_time_summary',
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.command == 'import-summary':
+        import_summary()
+
+
+if __name__ == '__main__':
+    main()
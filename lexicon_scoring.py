@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""Batch versions of the AFINN and VADER scorers.
+
+Both give exactly the same scores as calling the libraries on one text at
+a time, which can be checked with:
+    python lexicon_scoring.py"""
+import re
+import sys
+import numpy as np
+import pandas as pd
+from afinn import Afinn
+from afinn.afinn import LANGUAGE_TO_FILENAME
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer, SentiText, BOOSTER_DICT
+
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def trie_regex(tokens):
+    """Build a regex which matches the same token as an alternation of
+    `tokens` sorted longest first, but which is a trie, so it checks one
+    character at a time instead of trying each token in turn.
+
+    Where a token is a prefix of another, the longer continuation is tried
+    first, so the first match found is the longest."""
+    trie = {}
+    for token in tokens:
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char != '']
+        if len(branches) == 0:
+            return ''
+        if len(branches) == 1:
+            regex = branches[0]
+        else:
+            regex = '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            regex = '(?:' + regex + ')?'
+        return regex
+
+    return '(?:' + build(trie) + ')'
+
+
+class AfinnBatchScorer:
+    """Score a list of texts with AFINN, using one regex scan over the
+    whole list.
+
+    Each text is cleaned and lowercased the same way Afinn.find_all() does
+    it, then the texts are joined with newlines. A cleaned text contains no
+    newlines, and no AFINN word or emoticon contains a newline, so a match
+    can never cross from one text into the next. Multi-word entries such as
+    "cashing in" contain spaces, which is fine. The valence of each match
+    is added to its text with np.bincount()."""
+    def __init__(self):
+        self._analyzer = Afinn(emoticons=True)
+        tokens = list(self._analyzer._dict)
+        self.token_index = {token: i for i, token in enumerate(tokens)}
+        self.valences = np.array([self._analyzer._dict[token] for token in tokens], dtype=np.float64)
+        # Same as the pattern from Afinn(emoticons=True), with words before
+        # emoticons
+        words = Afinn.read_word_file(self._analyzer.full_filename(LANGUAGE_TO_FILENAME['en']))
+        emoticons = Afinn.read_word_file(self._analyzer.full_filename(LANGUAGE_TO_FILENAME['emoticons']))
+        self.pattern = re.compile(r'\b' + trie_regex(words) + r'\b|' + trie_regex(emoticons))
+
+    def score(self, text):
+        cleaned = [WHITESPACE.sub(' ', i).lower() for i in text]
+        lengths = np.array([len(i) + 1 for i in cleaned], dtype=np.int64)
+        starts = np.cumsum(lengths) - lengths
+        matches = list(self.pattern.finditer('\n'.join(cleaned)))
+        positions = np.array([m.start() for m in matches], dtype=np.int64)
+        token_ids = np.array([self.token_index[m.group()] for m in matches], dtype=np.int64)
+        text_ids = np.searchsorted(starts, positions, side='right') - 1
+        return np.bincount(text_ids, weights=self.valences[token_ids], minlength=len(text))
+
+
+class VaderBatchScorer:
+    """Score a list of texts with VADER, returning the compound score.
+
+    VADER only gives a non-zero score to a text if one of its tokens is in
+    the lexicon. Those texts are found for the whole list at once, by
+    checking each distinct token once, and every other text scores 0.0.
+    Texts which do have a lexicon word are scored with VADER's own rules.
+    The per-character emoji replacement is skipped for texts without an
+    emoji, since it doesn't change them."""
+    def __init__(self):
+        self._analyzer = SentimentIntensityAnalyzer()
+        # polarity_scores() replaces emoji one character at a time
+        self.emoji_chars = set(emoji for emoji in self._analyzer.emojis if len(emoji) == 1)
+
+    def find_lexicon_words(self, text):
+        """Return a bool array, True for texts which have any token that
+        might be in the lexicon."""
+        tokens = pd.Series(list(text), dtype=object).str.split().explode().dropna()
+        codes, uniques = pd.factorize(tokens)
+        lexicon = self._analyzer.lexicon
+        in_lexicon = np.array(
+            [SentiText._strip_punc_if_word(token).lower() in lexicon for token in uniques],
+            dtype=bool,
+        )
+        found = np.zeros(len(text), dtype=bool)
+        found[tokens.index[in_lexicon[codes]].to_numpy(dtype=np.int64)] = True
+        return found
+
+    def score_without_emoji(self, text):
+        """Same as SentimentIntensityAnalyzer.polarity_scores(), for a text
+        with no emoji."""
+        analyzer = self._analyzer
+        text = text.strip()
+        sentitext = SentiText(text)
+        sentiments = []
+        words_and_emoticons = sentitext.words_and_emoticons
+        for i, item in enumerate(words_and_emoticons):
+            valence = 0
+            if item.lower() in BOOSTER_DICT:
+                sentiments.append(valence)
+                continue
+            if (i < len(words_and_emoticons) - 1 and item.lower() == "kind" and
+                    words_and_emoticons[i + 1].lower() == "of"):
+                sentiments.append(valence)
+                continue
+            sentiments = analyzer.sentiment_valence(valence, sentitext, item, i, sentiments)
+        sentiments = analyzer._but_check(words_and_emoticons, sentiments)
+        return analyzer.score_valence(sentiments, text)['compound']
+
+    def score(self, text):
+        scores = np.zeros(len(text), dtype=np.float64)
+        has_emoji = np.array([not self.emoji_chars.isdisjoint(i) for i in text], dtype=bool)
+        has_lexicon_word = self.find_lexicon_words(text)
+        for i in np.flatnonzero(has_emoji):
+            scores[i] = self._analyzer.polarity_scores(text[i])['compound']
+        for i in np.flatnonzero(~has_emoji & has_lexicon_word):
+            scores[i] = self.score_without_emoji(text[i])
+        return scores
+
+
+# Texts for checking that the batch scorers match the libraries. These cover
+# negation, boosters, all caps, "kind of", "but", emoji, emoticons, multi-word
+# AFINN entries, unusual whitespace, and texts with no lexicon words.
+PARITY_CORPUS = [
+    '',
+    ' ',
+    'Just posted a photo @ Central Park',
+    'I love this place',
+    'I do not love this place',
+    'I don\'t love this place at all',
+    'This is not bad',
+    'This is NOT GOOD at all!!!',
+    'The food was GREAT but the service was terrible',
+    'The food was great, but the service was terrible.',
+    'It was kind of ok I guess',
+    'Extremely happy with how today went',
+    'Somewhat disappointed :(',
+    'Best day ever :) :-) :D',
+    'Good morning ☀️ #sunday',
+    '😂😂😂 I can\'t even',
+    'Sunset 🌅 over the lake😍',
+    'No problem at all',
+    'no good no fun',
+    'Stop cashing in on the hype',
+    'Cashing\tin again, no fun',
+    'Not only good but great',
+    'Never so bad as this',
+    'The movie was the shit',
+    'That test was the bomb',
+    'I\'m sooo tired of this. Ugh.',
+    'Daylight saving time is the worst. #DST',
+    'cool stuff happening downtown',
+    'This does not work',
+    'Wow!!! Amazing!!!',
+    'What a terrible, horrible, no good, very bad day?!?',
+    'Meh.',
+    'Tab\tseparated\tgood\ttext',
+    'Line one is sad\nline two is happy',
+    'Ｆｕｌｌｗｉｄｔｈ ｇｏｏｄ',
+    'İstanbul is lovely',
+    'café au lait, très bien',
+    'https://t.co/abc123 win win win',
+    '@someone thanks so much!',
+    'I am not happy, but not sad either',
+    'kind of',
+    'KIND OF AWESOME',
+]
+
+
+def check_parity(text):
+    """Return the number of texts where each batch scorer differs from the
+    library it replaces."""
+    afinn = Afinn(emoticons=True)
+    vader = SentimentIntensityAnalyzer()
+    afinn_reference = np.array([afinn.score(i) for i in text])
+    vader_reference = np.array([vader.polarity_scores(i)['compound'] for i in text])
+    afinn_batch = AfinnBatchScorer().score(text)
+    vader_batch = VaderBatchScorer().score(text)
+    afinn_mismatches = np.flatnonzero(afinn_batch != afinn_reference)
+    vader_mismatches = np.flatnonzero(vader_batch != vader_reference)
+    for i in afinn_mismatches:
+        print(f'afinn mismatch: {text[i]!r} {afinn_batch[i]} != {afinn_reference[i]}')
+    for i in vader_mismatches:
+        print(f'vader mismatch: {text[i]!r} {vader_batch[i]} != {vader_reference[i]}')
+    return len(afinn_mismatches), len(vader_mismatches)
+
+
+def main():
+    afinn_mismatches, vader_mismatches = check_parity(PARITY_CORPUS)
+    print(f'{len(PARITY_CORPUS)} texts: {afinn_mismatches} afinn mismatches, '
+          f'{vader_mismatches} vader mismatches')
+    if afinn_mismatches != 0 or vader_mismatches != 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,18 @@
-import json
+import ndjson
+import staging
+
+import os
 import pandas as pd
 
 
 tweets = []
 
-with open('tweets.json', 'rt') as f:
-    for tweet_str in f:
-        tweet = json.loads(tweet_str)
-        tweets.append(tweet)
+if staging.staging_exists():
+    for tweet_chunk in staging.read_tweets():
+        tweets.extend(tweet_chunk)
+if os.path.exists('tweets.json'):
+    for tweet_chunk, offset in ndjson.read_parallel('tweets.json', project=ndjson.project_tweet):
+        tweets.extend(tweet_chunk)
 df = pd.json_normalize(tweets)
 print(df.columns)
 print(df)
@@ -0,0 +1,95 @@
+"""Fast reader for newline-delimited JSON files, such as tweets.json.
+
+Uses orjson to decode if it's installed, and falls back to the standard
+library otherwise. Large files are split into byte ranges which end on a
+newline, so that several processes can parse one file at once."""
+import collections
+import json
+import multiprocessing
+import os
+
+try:
+    import orjson
+    # orjson.JSONDecodeError is a subclass of json.JSONDecodeError
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+
+# Fields of each tweets.json line used by clean_tweets
+TWEET_FIELDS = ['id', 'created_at', 'author_id', 'text']
+
+
+def project_tweet(obj):
+    """Keep only the fields of a tweets.json line which are used by
+    insert_tweets() and read_places_resumable()."""
+    tweet = obj['tweet']
+    projected = {
+        'tweet': {field: tweet[field] for field in TWEET_FIELDS if field in tweet},
+    }
+    if 'geo' in tweet:
+        projected['tweet']['geo'] = {'place_id': tweet['geo']['place_id']}
+    if 'place' in obj:
+        projected['place'] = obj['place']
+    return projected
+
+
+def get_shards(filename, shard_bytes=16 * 1024 * 1024, start=0):
+    """Split a file into (start, end) byte ranges of about shard_bytes each.
+    Every range except possibly the last ends just after a newline."""
+    size = os.path.getsize(filename)
+    shards = []
+    with open(filename, 'rb') as f:
+        while start < size:
+            end = min(start + shard_bytes, size)
+            if end < size:
+                # Move forward to the end of the current line
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+def read_shard(filename, start, end, project=None):
+    """Parse the lines between byte offsets start and end. Returns the
+    objects, and the offset just past the last complete line.
+
+    A final line without a newline is treated as still being written, and
+    is skipped."""
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    objects = []
+    offset = start
+    for line in data.split(b'\n')[:-1]:
+        try:
+            obj = loads(line)
+        except json.decoder.JSONDecodeError as e:
+            raise Exception(f'Error at byte offset {offset} of {filename}') from e
+        if project is not None:
+            obj = project(obj)
+        objects.append(obj)
+        offset += len(line) + 1
+    return objects, offset
+
+
+def read_parallel(filename, processes=None, project=None, shard_bytes=16 * 1024 * 1024, start=0):
+    """Parse a file in parallel, one shard per task. Yields (objects, offset)
+    for each shard in file order, where offset is the byte offset just past
+    the shard.
+
+    At most two shards per process are parsed ahead of the consumer, to
+    bound memory use."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    shards = get_shards(filename, shard_bytes, start)
+    with multiprocessing.Pool(processes) as p:
+        pending = collections.deque()
+        for shard_start, shard_end in shards:
+            pending.append(p.apply_async(read_shard, (filename, shard_start, shard_end, project)))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
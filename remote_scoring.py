@@ -0,0 +1,135 @@
+"""Wire protocol and client for scoring text with analyzer_server.
+
+Requests and responses are msgpack maps. A request has an id, the list of
+texts, and a CRC32 checksum of the texts. The response has the same id,
+the checksum of the texts the server received, and the scores as
+little-endian float32 bytes. Checking the id and checksum replaces
+echoing the text back to the client.
+
+analyzer_server imports this module, so util is only imported by
+create_client(), and not at load time."""
+import concurrent.futures
+import itertools
+import time
+import urllib.parse
+import uuid
+import zlib
+import msgpack
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+
+CONTENT_TYPE = 'application/x-msgpack'
+SCORE_DTYPE = '<f4'
+DEFAULT_ENDPOINTS = ['http://192.168.2.242:8080/']
+
+
+def text_checksum(text):
+    checksum = 0
+    for i in text:
+        checksum = zlib.crc32(i.encode('utf-8') + b'\0', checksum)
+    return checksum
+
+
+def encode_request(request_id, text):
+    return msgpack.packb({
+        'id': request_id,
+        'text': text,
+        'checksum': text_checksum(text),
+    })
+
+
+def decode_request(body):
+    content = msgpack.unpackb(body)
+    if text_checksum(content['text']) != content['checksum']:
+        raise Exception(f'Checksum mismatch in request {content["id"]}')
+    return content['id'], content['text']
+
+
+def encode_response(request_id, text, scores):
+    return msgpack.packb({
+        'id': request_id,
+        'checksum': text_checksum(text),
+        'scores': np.asarray(scores, dtype=SCORE_DTYPE).tobytes(),
+    })
+
+
+def decode_response(body, request_id, text):
+    content = msgpack.unpackb(body)
+    if content['id'] != request_id:
+        raise Exception(f'Response for request {content["id"]}, expected {request_id}')
+    if content['checksum'] != text_checksum(text):
+        raise Exception(f'Checksum mismatch in response to request {request_id}')
+    scores = np.frombuffer(content['scores'], dtype=SCORE_DTYPE)
+    assert len(scores) == len(text)
+    return scores.astype(np.float64)
+
+
+class RemoteScoringClient:
+    """Score text with one or more analyzer_servers.
+
+    Text is sent in chunks, with up to in_flight requests outstanding at
+    once over a pooled keep-alive session. Chunks are spread over the
+    endpoints round-robin."""
+    def __init__(self, endpoints, chunk_size=1000, in_flight=4):
+        self.endpoints = endpoints
+        self.chunk_size = chunk_size
+        self.in_flight = in_flight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(endpoints), pool_maxsize=in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = concurrent.futures.ThreadPoolExecutor(in_flight)
+        self.endpoint_cycle = itertools.cycle(endpoints)
+        self.version = None
+
+    def score_chunk(self, endpoint, text):
+        request_id = uuid.uuid4().hex
+        body = encode_request(request_id, text)
+        while True:
+            response = self.session.post(endpoint, data=body, headers={'Content-Type': CONTENT_TYPE})
+            if response.status_code != 429:
+                break
+            # Server queue is full
+            time.sleep(float(response.headers.get('Retry-After', 1)))
+        response.raise_for_status()
+        return decode_response(response.content, request_id, text)
+
+    def get_version(self):
+        """Get the model and backend the servers score with, as
+        '<model>-<backend>'. Raises an exception if the servers differ."""
+        if self.version is None:
+            versions = set()
+            for endpoint in self.endpoints:
+                response = self.session.get(urllib.parse.urljoin(endpoint, 'version'))
+                response.raise_for_status()
+                content = response.json()
+                versions.add(f'{content["model"]}-{content["backend"]}')
+            if len(versions) != 1:
+                raise Exception(f'Servers score with different models: {sorted(versions)}')
+            self.version = versions.pop()
+        return self.version
+
+    def score(self, text):
+        """Score a list of texts. Returns a numpy array of scores."""
+        text = list(text)
+        futures = [
+            self.executor.submit(self.score_chunk, next(self.endpoint_cycle), text[i:i + self.chunk_size])
+            for i in range(0, len(text), self.chunk_size)
+        ]
+        scores = [future.result() for future in futures]
+        if len(scores) == 0:
+            return np.zeros(0)
+        return np.concatenate(scores)
+
+
+def create_client():
+    """Create a client using the bert_endpoints and bert_in_flight settings
+    in config.json."""
+    import util
+    config = util.get_config()
+    return RemoteScoringClient(
+        config.get('bert_endpoints', DEFAULT_ENDPOINTS),
+        in_flight=config.get('bert_in_flight', 4),
+    )
@@ -1,32 +1,59 @@
 """For computing sentiment scoring of various tweets."""
 import util
+import bert_inference
+import score_cache
+import lexicon_scoring
+import remote_scoring
 
-import requests
-from afinn import Afinn
-import datasets
-from pysentimiento import create_analyzer
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+import importlib.metadata
 import multiprocessing
 import argparse
 
 
 class Scorer:
+    # Set to False to score every tweet without using score_cache
+    use_cache = True
+
     def __init__(self):
         pass
 
     def score_tweet_df(self, tweet_df):
-        """Score tweets using sentiment."""
+        """Score tweets using sentiment.
+
+        Each distinct text is scored once, and texts seen before are looked
+        up in score_cache. Cache statistics are put in
+        tweet_df.attrs['score_cache']."""
         text = tweet_df['tweet_text'].values
-        if len(text) != 0:
-            # Call method with text for each tweet
-            scores = self.score_tweets(text)
+        # Normalized text is scored either way, so using the cache doesn't
+        # change the scores
+        normalized = [score_cache.normalize_text(i) for i in text]
+        if not self.use_cache:
+            scores = self.score_tweets(normalized) if len(normalized) != 0 else []
+            stats = score_cache.empty_stats()
         else:
-            # There are zero tweets to score.
-            # Don't call score method.
-            scores = []
+            hashes = [score_cache.normalized_text_hash(i) for i in normalized]
+            # Score the normalized text which the hash is made from, so the
+            # cached score doesn't depend on which variant was seen first
+            distinct = {}
+            for h, i in zip(hashes, normalized):
+                distinct.setdefault(h, i)
+            hash_scores = score_cache.read_scores(self.method, self.version, distinct.keys())
+            missing = [h for h in distinct if h not in hash_scores]
+            if len(missing) != 0:
+                # Call method with text for each tweet not in cache
+                computed = dict(zip(missing, self.score_tweets([distinct[h] for h in missing])))
+                score_cache.write_scores(self.method, self.version, computed)
+                hash_scores.update(computed)
+            scores = [hash_scores[h] for h in hashes]
+            stats = {
+                'rows': len(text),
+                'unique': len(distinct),
+                'hits': len(distinct) - len(missing),
+            }
         tweet_df['score'] = scores
         tweet_df['type'] = self.method
         tweet_df = tweet_df[['tweet_id', 'type', 'score']]
+        tweet_df.attrs['score_cache'] = stats
         return tweet_df
 
     def score_tweets(self, text):
@@ -36,45 +63,51 @@ class Scorer:
 class AfinnScorer(Scorer):
     def __init__(self):
         self.method = 'afinn'
-        self._analyzer = Afinn(emoticons=True)
+        self.version = importlib.metadata.version('afinn') + '-emoticons'
+        # Same scores as Afinn(emoticons=True).score() on each text
+        self._analyzer = lexicon_scoring.AfinnBatchScorer()
         self.parallelism = multiprocessing.cpu_count()
 
     def score_tweets(self, text):
-        return [self._analyzer.score(i) for i in text]
+        return self._analyzer.score(text).tolist()
 
 
 class BertScorer(Scorer):
-    def __init__(self):
+    def __init__(self, backend=None):
         self.method = 'bert'
-        self._analyzer = create_analyzer(task='sentiment', lang='en')
+        if backend is None:
+            # Backend is one of bert_inference.BACKENDS. Check that it
+            # agrees with the default before switching, by running
+            # bert_inference.py.
+            backend = util.get_config().get('bert_backend', 'torch')
+        self.backend = backend
+        self._analyzer = bert_inference.create_sentiment_analyzer()
+        # Inference is parallelized across threads by torch, rather than
+        # across processes
+        self._engine = bert_inference.create_engine(self._analyzer, backend)
         self.parallelism = 1
         self.local = True
+        # Client for analyzer_server, used when self.local is False
+        self._client = None
+
+    @property
+    def version(self):
+        if self.local:
+            return f'{self._analyzer.model.name_or_path}-{self.backend}'
+        # Cache scores under the model and backend of the server which
+        # computes them, not the local configuration
+        return self.get_client().get_version()
+
+    def get_client(self):
+        if self._client is None:
+            self._client = remote_scoring.create_client()
+        return self._client
 
     def score_tweets(self, text):
-        datasets.set_progress_bar_enabled(False)
         if self.local:
-            probabilities = self._analyzer.predict(text)
-            # Convert probabilities of each class to sentiment score
-            scores = [
-                -5 * i.probas['NEG'] +
-                0 * i.probas['NEU'] +
-                5 * i.probas['POS']
-                for i in probabilities
-            ]
+            scores = self._engine.score(list(text)).tolist()
         else:
-            text = list(text)
-            url = 'http://192.168.2.242:8080/'
-            scores = []
-            text_returned = []
-            for text_chunk in util.chunks(text, 1000):
-                response = requests.post(url, json={'text': text_chunk})
-                response.raise_for_status()
-                response_json = response.json()
-                assert isinstance(response_json['scores'], list)
-                assert len(response_json['scores']) == len(text_chunk)
-                scores.extend(response_json['scores'])
-                text_returned.extend(response_json['text'])
-            assert text == text_returned
+            scores = self.get_client().score(text).tolist()
         assert len(scores) == len(text)
         return scores
 
@@ -82,11 +115,14 @@ class BertScorer(Scorer):
 class VaderScorer(Scorer):
     def __init__(self):
         self.method = 'vader'
-        self._analyzer = SentimentIntensityAnalyzer()
+        self.version = importlib.metadata.version('vaderSentiment')
+        # Same scores as SentimentIntensityAnalyzer().polarity_scores()
+        # on each text
+        self._analyzer = lexicon_scoring.VaderBatchScorer()
         self.parallelism = multiprocessing.cpu_count()
 
     def score_tweets(self, text):
-        return [self._analyzer.polarity_scores(i)['compound'] for i in text]
+        return self._analyzer.score(text).tolist()
 
 
 scorers = {
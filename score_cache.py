@@ -0,0 +1,86 @@
+"""Persistent cache of sentiment scores, keyed by scoring method, model
+version, and a hash of the normalized tweet text.
+
+Many geotagged tweets have the same text, e.g. check-ins posted by bots, so
+each distinct text only needs to be scored once per method."""
+import util
+
+import hashlib
+import os
+import re
+import sqlite3
+import unicodedata
+
+
+score_cache_db = {}
+
+
+def get_score_cache_db():
+    """Open the on-disk score cache. Each process opens its own connection,
+    so this is safe to call from a Pool worker."""
+    pid = os.getpid()
+    if pid not in score_cache_db:
+        filename = util.script_relative('score_cache.db')
+        con = sqlite3.connect(filename, timeout=60)
+        con.execute('pragma journal_mode=wal')
+        con.execute("""
+            create table if not exists score_cache
+                (method text, version text, text_hash blob, score real,
+                primary key (method, version, text_hash)) without rowid""")
+        con.commit()
+        score_cache_db[pid] = con
+    return score_cache_db[pid]
+
+
+def normalize_text(text):
+    # Texts which differ only in unicode composition or whitespace are
+    # treated as the same text
+    text = unicodedata.normalize('NFC', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def normalized_text_hash(normalized):
+    """Hash text which has already been through normalize_text()."""
+    return hashlib.sha1(normalized.encode('utf-8')).digest()
+
+
+def read_scores(method, version, hashes):
+    con = get_score_cache_db()
+    found = {}
+    for hash_chunk in util.chunks(list(hashes), 500):
+        placeholders = ', '.join('?' * len(hash_chunk))
+        rows = con.execute(
+            f"""
+            select text_hash, score from score_cache
+            where method = ? and version = ? and text_hash in ({placeholders})""",
+            (method, version, *hash_chunk),
+        ).fetchall()
+        found.update(rows)
+    return found
+
+
+def write_scores(method, version, hash_scores):
+    con = get_score_cache_db()
+    rows = [(method, version, h, score) for h, score in hash_scores.items()]
+    con.executemany('insert or replace into score_cache values (?, ?, ?, ?)', rows)
+    con.commit()
+
+
+def empty_stats():
+    return {'rows': 0, 'unique': 0, 'hits': 0}
+
+
+def add_stats(total, stats):
+    for key in total:
+        total[key] += stats[key]
+    return total
+
+
+def format_stats(method, stats):
+    rows = stats['rows']
+    unique = stats['unique']
+    hits = stats['hits']
+    scored = unique - hits
+    hit_rate = (rows - scored) / rows * 100 if rows != 0 else 0
+    return f'{method}: {rows} tweets, {unique} distinct texts, {hits} cached, ' \
+        f'{scored} scored ({hit_rate:.1f}% of tweets not scored)'
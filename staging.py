@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""Columnar Parquet staging format for fetched tweets.
+
+This is an alternative to appending JSON to tweets.json. Each fetch run
+writes Parquet files into STAGING_DIR with a fixed schema for tweet, user
+and place fields. Readers use memory mapping, and only decode the columns
+they need.
+
+To convert an existing tweets.json:
+    python staging.py tweets.json
+
+clean_tweets reads tweets.json as well as the staging files, so move the
+converted tweets.json out of the way to avoid reading its tweets twice."""
+import ndjson
+
+import argparse
+import datetime
+import glob
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+
+STAGING_DIR = 'tweets_staging'
+
+SCHEMA = pa.schema([
+    # Tweet
+    ('tweet_id', pa.string()),
+    ('created_at', pa.string()),
+    ('author_id', pa.string()),
+    ('text', pa.string()),
+    ('geo_place_id', pa.string()),
+    ('retweet_count', pa.int64()),
+    ('reply_count', pa.int64()),
+    ('like_count', pa.int64()),
+    ('quote_count', pa.int64()),
+    # User
+    ('user_id', pa.string()),
+    ('username', pa.string()),
+    ('user_name', pa.string()),
+    ('user_description', pa.string()),
+    ('user_location', pa.string()),
+    ('followers_count', pa.int64()),
+    ('following_count', pa.int64()),
+    ('tweet_count', pa.int64()),
+    ('listed_count', pa.int64()),
+    # Place
+    ('place_id', pa.string()),
+    ('place_name', pa.string()),
+    ('place_full_name', pa.string()),
+    ('place_minx', pa.float64()),
+    ('place_miny', pa.float64()),
+    ('place_maxx', pa.float64()),
+    ('place_maxy', pa.float64()),
+])
+
+# Columns needed to rebuild the fields used by clean_tweets
+TWEET_COLUMNS = ['tweet_id', 'created_at', 'author_id', 'text', 'geo_place_id']
+PLACE_COLUMNS = ['place_id', 'place_name', 'place_full_name',
+                 'place_minx', 'place_miny', 'place_maxx', 'place_maxy']
+
+
+def flatten_tweet(obj):
+    """Convert one fetched tweet, in the format written to tweets.json, into
+    a row matching SCHEMA."""
+    tweet = obj['tweet']
+    user = obj.get('user') or {}
+    place = obj.get('place') or {}
+    tweet_metrics = tweet.get('public_metrics') or {}
+    user_metrics = user.get('public_metrics') or {}
+    bbox = (place.get('geo') or {}).get('bbox') or [None] * 4
+    return {
+        'tweet_id': tweet['id'],
+        'created_at': tweet.get('created_at'),
+        'author_id': tweet.get('author_id'),
+        'text': tweet.get('text'),
+        'geo_place_id': (tweet.get('geo') or {}).get('place_id'),
+        'retweet_count': tweet_metrics.get('retweet_count'),
+        'reply_count': tweet_metrics.get('reply_count'),
+        'like_count': tweet_metrics.get('like_count'),
+        'quote_count': tweet_metrics.get('quote_count'),
+        'user_id': user.get('id'),
+        'username': user.get('username'),
+        'user_name': user.get('name'),
+        'user_description': user.get('description'),
+        'user_location': user.get('location'),
+        'followers_count': user_metrics.get('followers_count'),
+        'following_count': user_metrics.get('following_count'),
+        'tweet_count': user_metrics.get('tweet_count'),
+        'listed_count': user_metrics.get('listed_count'),
+        'place_id': place.get('id'),
+        'place_name': place.get('name'),
+        'place_full_name': place.get('full_name'),
+        'place_minx': bbox[0],
+        'place_miny': bbox[1],
+        'place_maxx': bbox[2],
+        'place_maxy': bbox[3],
+    }
+
+
+def row_to_tweet(row):
+    """Convert a staged row back into the nested format produced by
+    ndjson.project_tweet()."""
+    tweet = {
+        'tweet': {
+            'id': row['tweet_id'],
+            'created_at': row['created_at'],
+            'author_id': row['author_id'],
+            'text': row['text'],
+            'geo': {'place_id': row['geo_place_id']},
+        },
+    }
+    if row.get('place_id') is not None:
+        tweet['place'] = row_to_place(row)
+    return tweet
+
+
+def row_to_place(row):
+    return {
+        'id': row['place_id'],
+        'name': row['place_name'],
+        'full_name': row['place_full_name'],
+        'geo': {
+            'bbox': [row['place_minx'], row['place_miny'], row['place_maxx'], row['place_maxy']],
+        },
+    }
+
+
+def fsync_file(filename):
+    """fsync a file or directory by name."""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class StagingWriter:
+    """Write fetched tweets into Parquet files in STAGING_DIR.
+
+    Rows are buffered and written one row group at a time. A new file is
+    started every rows_per_file rows, so a crash loses at most one file.
+    Files are renamed to *.parquet once complete, so readers never see a
+    partially written file."""
+    def __init__(self, directory=STAGING_DIR, row_group_size=10000, rows_per_file=200000):
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.rows_per_file = rows_per_file
+        self._rows = []
+        self._writer = None
+        self._filename = None
+        self._rows_in_file = 0
+        self._file_number = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, tweets):
+        self._rows.extend(flatten_tweet(tweet) for tweet in tweets)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._rows) == 0:
+            return
+        if self._writer is None:
+            timestamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+            self._filename = os.path.join(
+                self.directory, f'part-{timestamp}-{os.getpid()}-{self._file_number}.parquet')
+            self._file_number += 1
+            self._writer = pq.ParquetWriter(self._filename + '.tmp', SCHEMA, compression='zstd')
+        self._writer.write_table(pa.Table.from_pylist(self._rows, schema=SCHEMA))
+        self._rows_in_file += len(self._rows)
+        self._rows = []
+        if self._rows_in_file >= self.rows_per_file:
+            self._close_file()
+
+    def _close_file(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        # Make the file and its rename durable before the interval ledger
+        # records the pages in it
+        fsync_file(self._filename + '.tmp')
+        os.replace(self._filename + '.tmp', self._filename)
+        fsync_file(self.directory)
+        self._writer = None
+        self._rows_in_file = 0
+
+    def checkpoint(self):
+        """Make every row written so far durable, by finishing the current
+        file."""
+        self.flush()
+        self._close_file()
+
+    def close(self):
+        self.flush()
+        self._close_file()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def get_staged_files(directory=STAGING_DIR):
+    return sorted(glob.glob(os.path.join(directory, '*.parquet')))
+
+
+def staging_exists(directory=STAGING_DIR):
+    return len(get_staged_files(directory)) > 0
+
+
+def count_rows(directory=STAGING_DIR):
+    """Count staged rows using only the Parquet metadata."""
+    return sum(pq.ParquetFile(filename).metadata.num_rows for filename in get_staged_files(directory))
+
+
+def read_file(filename, columns, batch_size=10000):
+    """Yield record batches from a staged file, with memory mapping, and
+    only reading `columns`."""
+    parquet_file = pq.ParquetFile(filename, memory_map=True)
+    yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+
+
+def read_tweets(directory=STAGING_DIR, batch_size=10000):
+    """Yield lists of tweets in the format produced by ndjson.project_tweet()."""
+    for filename in get_staged_files(directory):
+        for batch in read_file(filename, TWEET_COLUMNS + PLACE_COLUMNS, batch_size):
+            yield [row_to_tweet(row) for row in batch.to_pylist()]
+
+
+def read_places(filename, batch_size=10000):
+    """Yield lists of places from one staged file, skipping tweets without
+    a place."""
+    for batch in read_file(filename, PLACE_COLUMNS, batch_size):
+        yield [row_to_place(row) for row in batch.to_pylist() if row['place_id'] is not None]
+
+
+def convert_json(filename, directory=STAGING_DIR):
+    """One-time conversion of a tweets.json file into the staging format."""
+    with tqdm(total=os.path.getsize(filename), unit='B', unit_scale=True) as prog:
+        with StagingWriter(directory, rows_per_file=1000000) as writer:
+            last_offset = 0
+            for tweets, offset in ndjson.read_parallel(filename):
+                writer.write(tweets)
+                prog.update(offset - last_offset)
+                last_offset = offset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Convert tweets.json into the Parquet staging format'
+    )
+    parser.add_argument(
+        'filename',
+        nargs='?',
+        default='tweets.json',
+    )
+    parser.add_argument(
+        '--output',
+        default=STAGING_DIR,
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    convert_json(args.filename, args.output)
+
+
+if __name__ == '__main__':
+    main()
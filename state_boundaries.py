@@ -4,6 +4,7 @@ a geopandas dataframe.
 Also performs some cleaning of the shapefile."""
 
 import geopandas as gpd
+import numpy as np
 from functools import lru_cache
 import commentjson as cjson
 import json
@@ -127,6 +128,48 @@ def lookup_by_geospatial(place):
         return None
 
 
+def lookup_by_geospatial_bulk(places):
+    """Batch version of lookup_by_geospatial().
+
+    Runs one spatial index query for all of the places, and only computes
+    overlap percentages for places which touch more than one state."""
+    if len(places) == 0:
+        return []
+    polys = [util.get_bbox_from_place(place) for place in places]
+    polys = [poly.buffer(1e-4) if poly.area == 0 else poly for poly in polys]
+    states = get_states()
+    place_idx, state_idx = states.sindex.query(gpd.GeoSeries(polys), predicate='intersects')
+    # Group matching states by place
+    order = np.argsort(place_idx, kind='stable')
+    place_idx = place_idx[order]
+    state_idx = state_idx[order]
+    boundaries = np.searchsorted(place_idx, np.arange(len(polys) + 1))
+    matches = []
+    for i, poly in enumerate(polys):
+        intersecting_idx = state_idx[boundaries[i]:boundaries[i + 1]]
+        num_intersections = len(intersecting_idx)
+        if num_intersections == 0:
+            # No intersections
+            matches.append(None)
+        elif num_intersections == 1:
+            # Single intersection - return first one
+            matches.append(states.index[intersecting_idx[0]])
+        elif num_intersections == 50:
+            # Some tweets are "geocoded" to the entire US. Return no match
+            # in these cases.
+            matches.append(None)
+        else:
+            # At least two intersections
+            intersecting_states = states.iloc[np.sort(intersecting_idx)]
+            area_percentage = util.get_percentage_overlap(intersecting_states, poly)
+            if area_percentage.iloc[0] > 80:
+                # This bounding box is at least 80% in one state
+                matches.append(area_percentage.index[0])
+            else:
+                matches.append(None)
+    return matches
+
+
 def geocode_place_inner(place):
     if not isinstance(place, dict):
         raise Exception(f'expected place, not {type(place)}')
@@ -145,8 +188,34 @@ def geocode_place_inner(place):
     return None
 
 
-def geocode_place(place):
-    state = geocode_place_inner(place)
+def geocode_places_bulk_inner(places):
+    """Batch version of geocode_place_inner(). Applies the rules in the same
+    order, and does the geospatial lookup for the remaining places at once."""
+    states = [None] * len(places)
+    needs_geospatial = []
+    for i, place in enumerate(places):
+        if not isinstance(place, dict):
+            raise Exception(f'expected place, not {type(place)}')
+        # Places can be disabled if they're an error place or too ambiguous
+        if place_disabled(place):
+            continue
+        # Before doing any mapping, check if this has an override
+        if match := place_remapped(place):
+            states[i] = match
+            continue
+        # Check if the state name is in the place. e.g. Cleveland, OH
+        if match := lookup_by_name(place):
+            states[i] = match
+            continue
+        needs_geospatial.append(i)
+    # Check the bounding box. If it's mostly in one state, use that.
+    geospatial_matches = lookup_by_geospatial_bulk([places[i] for i in needs_geospatial])
+    for i, match in zip(needs_geospatial, geospatial_matches):
+        states[i] = match
+    return states
+
+
+def check_state(state):
     if state == 'DC':
         # Remove DC
         state = None
@@ -156,6 +225,15 @@ def geocode_place(place):
     return state
 
 
+def geocode_place(place):
+    return check_state(geocode_place_inner(place))
+
+
+def geocode_places_bulk(places):
+    """Geocode a list of places. Returns a state or None for each place."""
+    return [check_state(state) for state in geocode_places_bulk_inner(places)]
+
+
 if __name__ == '__main__':
     # with open('places.json', 'rt') as f:
     #     places = [place for place in map(json.loads, f)]
@@ -0,0 +1,112 @@
+"""Derive legal time columns from a tweet's UTC date and legal timezone
+offset, with polars.
+
+Shared by export_csv.py, which derives them while exporting, and
+tweet_features.py, which stores them in the tweet_features table, so that
+both give the same values. Only needs polars."""
+import polars as pl
+
+
+def localize_time(time_col, offset_col):
+    one_hour_in_microseconds = 60 * 60 * 1000 * 1000
+    time_int_us = time_col.dt.epoch('us')
+    time_localized = time_int_us + (offset_col * one_hour_in_microseconds).cast(int)
+    return time_localized.cast(pl.Datetime)
+
+
+def format_time(time_col):
+    """Expand time column into component parts, each one as an integer."""
+    col_list = [
+        time_col.dt.year().alias('legal_year'),
+        time_col.dt.month().alias('legal_month'),
+        time_col.dt.day().alias('legal_day'),
+        time_col.dt.hour().alias('legal_hour'),
+        time_col.dt.minute().alias('legal_minute'),
+        time_col.dt.second().alias('legal_second'),
+    ]
+    return col_list
+
+
+def get_spring_fall(tweet_df):
+    replace_dict = {
+        2: 'S',
+        3: 'S',
+        4: 'S',
+        5: 'S',
+        10: 'F',
+        11: 'F',
+        12: 'F',
+    }
+    tweet_df = tweet_df.with_column(
+        replace(tweet_df['month_number'], replace_dict, 'U').alias('spring_fall_indicator')
+    )
+    return tweet_df
+
+
+def replace(column, replace_dict, default_value=None):
+    # initiate the expression with `pl`
+    branch = pl
+
+    # for every value add a `when.then`
+    for from_value, to_value in replace_dict.items():
+        branch = branch.when(column == from_value).then(to_value)
+
+    # finish with an `otherwise`
+    return branch.otherwise(pl.lit(default_value))
+
+
+def get_transition_indicators(tweet_df):
+    tweet_df = tweet_df.lazy()
+    cols = [
+        (7, 'within_1wk_transition'),
+        (14, 'within_2wk_transition'),
+        (21, 'within_3wk_transition'),
+        (28, 'within_4wk_transition'),
+    ]
+    for days_limit, col_name in cols:
+        tweet_df = tweet_df.with_column(
+            (pl.col('days_since_transition').abs() < days_limit).cast(pl.datatypes.Int8).alias(col_name),
+        )
+    return tweet_df.collect()
+
+
+def derive_features(tweet_df):
+    tweet_df = tweet_df.lazy().with_columns([
+        pl.col('date').str.strptime(pl.Datetime, '%Y-%m-%dT%H:%M:%S.000Z'),
+    ]).collect()
+    tweet_df = tweet_df.with_column(
+        localize_time(tweet_df['date'], tweet_df['legal_time_offset_ci_point']).alias('legal_datetime')
+    )
+    tweet_df = tweet_df.with_columns([
+        tweet_df['legal_datetime'].dt.weekday().alias('legal_day_of_week'),
+        tweet_df['legal_datetime'].dt.month().alias('month_number'),
+    ])
+    tweet_df = tweet_df.with_columns(
+        format_time(tweet_df['legal_datetime'])
+    )
+
+    # Get spring/fall indicator
+    tweet_df = get_spring_fall(tweet_df)
+
+    # Get transition indicators
+    tweet_df = get_transition_indicators(tweet_df)
+    return tweet_df
+
+
+def cast_features(tweet_df):
+    """Cast columns read from tweet_features to the types that
+    derive_features() gives them."""
+    cols = [
+        pl.col('legal_datetime').cast(pl.Datetime),
+        pl.col('legal_year').cast(pl.Int32),
+        *[
+            pl.col(col).cast(pl.UInt32)
+            for col in ['legal_month', 'legal_day', 'legal_hour', 'legal_minute',
+                        'legal_second', 'legal_day_of_week']
+        ],
+        *[
+            pl.col(f'within_{weeks}wk_transition').cast(pl.Int8)
+            for weeks in range(1, 5)
+        ],
+    ]
+    return tweet_df.with_columns(cols)
@@ -9,16 +9,22 @@ import pytz
 import iteround
 import cachetools
 import functools
-import bisect
+import sqlite3
+import os
 from numbers import Number
 import sys
 
 
+# Release of timezone-boundary-builder to use. Changing this invalidates
+# the place_tz_area index.
+TIMEZONE_RELEASE = '2021c'
+
+
 @util.gdf_file_cache('shape/timezones.shp')
 def get_timezone_shapefile():
     filename = util.script_relative('shape/timezones.shapefile.zip')
     url = 'https://github.com/evansiroky/timezone-boundary-builder/releases/' \
-        'download/2021c/timezones.shapefile.zip'
+        f'download/{TIMEZONE_RELEASE}/timezones.shapefile.zip'
     util.maybe_download_file(url, filename)
     timezones = gpd.read_file('zip://' + filename)
     timezones = timezones.set_index('tzid').sort_index()
@@ -61,20 +67,96 @@ def lookup_by_geospatial(poly, recurse_limit=1):
     return tz_areas
 
 
-geospatial_cache = cachetools.Cache(128)
+# In-memory cache in front of the on-disk place_tz_area index
+geospatial_cache = cachetools.LRUCache(16384)
+place_tz_area_db = {}
+
+
+def get_place_tz_area_db():
+    """Open the on-disk index of place_id -> percentage overlap per tzid.
+
+    The index is shared between processes and between runs. Each process
+    opens its own connection, so this is safe to call from a Pool worker."""
+    pid = os.getpid()
+    if pid not in place_tz_area_db:
+        filename = util.script_relative('shape/place_tz_area.db')
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        con = sqlite3.connect(filename, timeout=60)
+        con.execute('pragma journal_mode=wal')
+        con.execute("""
+            create table if not exists place_tz_area
+                (release text, place_id text, tzid text, rank integer, percent real,
+                primary key (release, place_id, tzid))""")
+        # Rows computed from another shapefile release are stale
+        con.execute('delete from place_tz_area where release != ?', (TIMEZONE_RELEASE,))
+        con.commit()
+        place_tz_area_db[pid] = con
+    return place_tz_area_db[pid]
+
+
+def read_place_tz_areas(place_ids):
+    con = get_place_tz_area_db()
+    found = {}
+    for place_id_chunk in util.chunks(list(place_ids), 500):
+        placeholders = ', '.join('?' * len(place_id_chunk))
+        rows = con.execute(
+            f"""
+            select place_id, tzid, percent from place_tz_area
+            where release = ? and place_id in ({placeholders})
+            order by place_id, rank""",
+            (TIMEZONE_RELEASE, *place_id_chunk),
+        ).fetchall()
+        for place_id, tzid, percent in rows:
+            found.setdefault(place_id, {})[tzid] = percent
+    return {place_id: pd.Series(areas) for place_id, areas in found.items()}
+
+
+def write_place_tz_areas(place_areas):
+    con = get_place_tz_area_db()
+    rows = [
+        (TIMEZONE_RELEASE, place_id, tzid, rank, percent)
+        for place_id, areas in place_areas.items()
+        for rank, (tzid, percent) in enumerate(areas.items())
+    ]
+    con.executemany('insert or replace into place_tz_area values (?, ?, ?, ?, ?)', rows)
+    con.commit()
+
+
+def lookup_places_cached(place_bboxes):
+    """Look up timezone areas for a dict of place_id -> bbox.
+
+    Checks the in-memory cache, then the on-disk index, and only runs the
+    geospatial search for places that have never been seen before."""
+    result = {}
+    missing = []
+    for place_id in place_bboxes:
+        try:
+            result[place_id] = geospatial_cache[place_id]
+        except KeyError:
+            missing.append(place_id)
+    if len(missing) == 0:
+        return result
+    stored = read_place_tz_areas(missing)
+    computed = {}
+    for place_id in missing:
+        if place_id in stored:
+            areas = stored[place_id]
+        else:
+            bbox = place_bboxes[place_id]
+            assert len(bbox) == 4
+            poly = box(*bbox)
+            areas = lookup_by_geospatial(poly)
+            assert areas is not None, f"geospatial search failed for {place_id}"
+            computed[place_id] = areas
+        geospatial_cache[place_id] = areas
+        result[place_id] = areas
+    if len(computed) > 0:
+        write_place_tz_areas(computed)
+    return result
 
 
 def lookup_by_geospatial_cached(bbox, place_id):
-    try:
-        return geospatial_cache[place_id]
-    except KeyError:
-        pass
-    assert len(bbox) == 4
-    poly = box(*bbox)
-    areas = lookup_by_geospatial(poly)
-    assert areas is not None, f"geospatial search failed for {place_id}"
-    geospatial_cache[place_id] = areas
-    return areas
+    return lookup_places_cached({place_id: bbox})[place_id]
 
 
 @functools.lru_cache(128)
@@ -82,37 +164,151 @@ def lookup_timezone_by_name(tz_name):
     return pytz.timezone(tz_name)
 
 
+# Years covered by the transition table. This has a year of margin on
+# either side of the years we fetch tweets for.
+TRANSITION_TABLE_START_YEAR = 2013
+TRANSITION_TABLE_END_YEAR = 2022
+
+
+def epoch_us(time_naive):
+    """Microseconds since the epoch for a naive UTC datetime."""
+    return (time_naive - datetime.datetime(1970, 1, 1)) // datetime.timedelta(microseconds=1)
+
+
+def from_epoch_us(time_us):
+    """Inverse of epoch_us()."""
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=int(time_us))
+
+
+def find_transitions(tz, start_year, end_year):
+    """Find every change in UTC offset or DST for a timezone between the start
+    of start_year and the end of end_year.
+
+    Only uses the public tzinfo API, so this works for any tzinfo, not just
+    pytz. Returns the epoch microsecond time of each transition, and the UTC
+    offset in seconds and DST flag in effect from then on. The first entry is
+    the state at the start of the range."""
+    def get_state(t):
+        time_conv = datetime.datetime.fromtimestamp(t, tz)
+        return time_conv.utcoffset(), time_conv.dst()
+
+    seconds_in_day = 24 * 60 * 60
+    start = epoch_us(datetime.datetime(start_year, 1, 1)) // 10 ** 6
+    end = epoch_us(datetime.datetime(end_year + 1, 1, 1)) // 10 ** 6
+    times = [start]
+    states = [get_state(start)]
+    # Check the state once per day. Timezones never change more than once
+    # per day, so a binary search finds the exact second of each change.
+    for t in range(start + seconds_in_day, end + 1, seconds_in_day):
+        state = get_state(t)
+        if state == states[-1]:
+            continue
+        lo = t - seconds_in_day
+        hi = t
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if get_state(mid) == states[-1]:
+                lo = mid
+            else:
+                hi = mid
+        times.append(hi)
+        states.append(state)
+    times = np.array(times, dtype=np.int64) * 10 ** 6
+    offsets = np.array([offset.total_seconds() for offset, dst in states], dtype=np.int64)
+    dst = np.array([dst.total_seconds() != 0 for offset, dst in states])
+    return times, offsets, dst
+
+
+class TransitionTable:
+    """Array-backed table of UTC offsets for a set of timezones.
+
+    Every timezone is stored in one sorted array of keys. The key for a time
+    in a timezone is tz_idx * KEY_STRIDE plus microseconds since the start of
+    the table, so any mix of timezones and times is looked up with a single
+    np.searchsorted()."""
+    KEY_STRIDE = 2 ** 50
+
+    def __init__(self, tz_names, start_year, end_year):
+        self.tz_names = pd.Index(sorted(set(tz_names)))
+        self.start_year = start_year
+        self.end_year = end_year
+        self.start_us = epoch_us(datetime.datetime(start_year, 1, 1))
+        self.end_us = epoch_us(datetime.datetime(end_year + 1, 1, 1))
+        assert self.end_us - self.start_us < self.KEY_STRIDE
+        self.transitions = {}
+        keys = []
+        offsets = []
+        for tz_idx, tz_name in enumerate(self.tz_names):
+            times, tz_offsets, tz_dst = find_transitions(
+                lookup_timezone_by_name(tz_name), start_year, end_year)
+            self.transitions[tz_name] = times, tz_offsets, tz_dst
+            tz_keys = tz_idx * self.KEY_STRIDE + (times - self.start_us)
+            # The first entry is the state at the start of the table. Put it
+            # just before the table starts, so it isn't counted as a transition.
+            tz_keys[0] -= 1
+            keys.append(tz_keys)
+            offsets.append(tz_offsets)
+        self.keys = np.concatenate(keys)
+        self.offsets = np.concatenate(offsets)
+        assert (np.diff(self.keys) > 0).all()
+
+    def get_keys(self, tz_names, time_us):
+        tz_idx = self.tz_names.get_indexer(tz_names)
+        time_us = np.asarray(time_us, dtype=np.int64)
+        assert (tz_idx != -1).all(), 'timezone missing from transition table'
+        assert ((self.start_us <= time_us) & (time_us < self.end_us)).all(), \
+            'time outside of transition table'
+        return tz_idx * self.KEY_STRIDE + (time_us - self.start_us)
+
+    def get_transitions(self, tz_name):
+        return self.transitions[tz_name]
+
+    def utc_offset(self, tz_names, time_us):
+        """UTC offset in seconds for each (timezone, epoch microsecond) pair."""
+        idx = np.searchsorted(self.keys, self.get_keys(tz_names, time_us), side='right') - 1
+        return self.offsets[idx]
+
+    def experiences_dst(self, tz_names, years):
+        """Whether each timezone has a transition during the given year, up to
+        the start of December 31st."""
+        years = np.asarray(years)
+        start_of_year = (years - 1970).astype('datetime64[Y]').astype('datetime64[us]')
+        dec_31 = (years + 1 - 1970).astype('datetime64[Y]').astype('datetime64[us]') - np.timedelta64(1, 'D')
+        lo = np.searchsorted(self.keys, self.get_keys(tz_names, start_of_year.astype(np.int64)), side='left')
+        hi = np.searchsorted(self.keys, self.get_keys(tz_names, dec_31.astype(np.int64)), side='right')
+        return hi > lo
+
+
+@functools.lru_cache(None)
+def get_transition_table():
+    tz_names = [*get_timezone_shapefile().index, 'America/Denver']
+    return TransitionTable(tz_names, TRANSITION_TABLE_START_YEAR, TRANSITION_TABLE_END_YEAR)
+
+
 @functools.lru_cache(128)
 def get_dst_changeover_for_year(year, spring=True):
     # Look up DST transitions from this timezone
-    tz = lookup_timezone_by_name('America/Denver')
+    times, offsets, _ = get_transition_table().get_transitions('America/Denver')
     # Set time_naive to a time after the transition of interest
     if spring:
         time_naive = datetime.datetime(year, 6, 1)
     else:
         time_naive = datetime.datetime(year, 12, 1)
-    # Using bisect_right(), perform a binary search for the transition
-    idx = max(0, bisect.bisect_right(tz._utc_transition_times, time_naive) - 1)
-    transition = tz._utc_transition_times[idx]
+    # Perform a binary search for the transition
+    idx = max(0, np.searchsorted(times, epoch_us(time_naive), side='right') - 1)
+    transition = from_epoch_us(times[idx])
     # Check that the transition is the same year as the changeover we're looking for
     assert transition.year == year, f'DST changeover too old, have {transition=}'
-    # Look up DST offset for transition, current DST transition, check that this
-    # is actually a 1 hr DST transition
-    dst_offset = tz._transition_info[idx][1]
-    prev_dst_offset = tz._transition_info[idx - 1][1]
-    assert abs((dst_offset - prev_dst_offset).total_seconds()) == 3600, \
-        f'Wrong DST change, have {(dst_offset - prev_dst_offset).total_seconds()=}'
-    transition = transition.replace(tzinfo=lookup_timezone_by_name('UTC'))
-    transition = transition.astimezone(tz).replace(tzinfo=None)
-    return transition
+    # Check that this is actually a 1 hr DST transition
+    assert idx > 0 and abs(offsets[idx] - offsets[idx - 1]) == 3600, \
+        f'Wrong DST change, have {offsets[idx] - offsets[idx - 1]=}'
+    # Convert to local time
+    return transition + datetime.timedelta(seconds=int(offsets[idx]))
 
 
 @functools.lru_cache(128)
-def get_timezone_experiences_dst(tz, year):
-    time = datetime.datetime(year, 12, 31)
-    idx = max(0, bisect.bisect_right(tz._utc_transition_times, time) - 1)
-    transition = tz._utc_transition_times[idx]
-    return transition.year == year
+def get_timezone_experiences_dst(tz_name, year):
+    return bool(get_transition_table().experiences_dst([tz_name], [year])[0])
 
 
 def get_transition_for_datetime(time):
@@ -125,10 +321,77 @@ def is_spring(time):
     return time.month <= 6
 
 
+# Constant controlling how many copies to make of each percentage of area
+# when summarizing a place that spans several timezones. Higher values make
+# a better approximation of statistical aggregates. The summary is computed
+# from weights rather than by repeating rows, so this costs nothing extra.
+NUMBER_COPIES_PER_PERCENT = 1
+
+
+def get_area_counts(areas, number_copies_per_percent=NUMBER_COPIES_PER_PERCENT):
+    """Round area percentages to whole numbers of copies so that the total
+    is preserved."""
+    area = areas * number_copies_per_percent
+    area = pd.Series(iteround.saferound(area.to_dict(), places=0, strategy='difference'))
+    area = area.round().astype(int)
+    assert area.sum() == 100 * number_copies_per_percent, \
+        f'area sums to {area.sum()}, should be {100 * number_copies_per_percent}'
+    return area
+
+
+def weighted_quantile(values, counts, q):
+    """np.quantile(), for each row of values, of the sample where column j
+    is repeated counts[j] times. Uses the same linear interpolation as
+    np.quantile() without building the repeated sample."""
+    total = counts.sum()
+    order = np.argsort(values, axis=1, kind='stable')
+    values_sorted = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(counts[order], axis=1)
+
+    def value_at(position):
+        idx = (cumulative <= position).sum(axis=1)
+        return values_sorted[np.arange(len(values)), idx]
+
+    virtual_index = q * (total - 1)
+    previous_index = np.floor(virtual_index)
+    next_index = min(previous_index + 1, total - 1)
+    gamma = virtual_index - previous_index
+    a = value_at(previous_index)
+    b = value_at(next_index)
+    diff_b_a = b - a
+    if gamma >= 0.5:
+        return b - diff_b_a * (1 - gamma)
+    return a + diff_b_a * gamma
+
+
+def summarize_multiple_tz(offset, dst, days_since_transition, timezone_experiences_dst, counts):
+    """Summarize a place which spans several timezones.
+
+    Each of the first four arguments is an array of shape (tweets, timezones),
+    and counts gives the number of copies of each timezone."""
+    counts = np.asarray(counts)
+    total = counts.sum()
+    lower = weighted_quantile(offset, counts, 0.025)
+    upper = weighted_quantile(offset, counts, 0.975)
+    point_estimate = (offset * counts).sum(axis=1) / total
+    # Ensure that the point estimate always lies within the range [lower, upper]
+    point_estimate = np.minimum(np.maximum(lower, point_estimate), upper)
+    is_dst = (dst * counts).sum(axis=1) / total
+    timezone_experiences_dst = (timezone_experiences_dst * counts).sum(axis=1) / total
+    # Get the most common number of days since transition. For each timezone,
+    # add up the copies of every timezone which agrees with it. Break ties by
+    # taking the smallest value, as Series.mode() does.
+    agree = days_since_transition[:, :, np.newaxis] == days_since_transition[:, np.newaxis, :]
+    copies = (agree * counts[np.newaxis, np.newaxis, :]).sum(axis=2)
+    is_mode = copies == copies.max(axis=1, keepdims=True)
+    days_since_transition = np.where(is_mode, days_since_transition, np.inf).min(axis=1)
+    return lower, point_estimate, upper, is_dst, days_since_transition, timezone_experiences_dst
+
+
 def localize_time_by_each_tz(time, tz_areas):
-    def get_tz_info(tz):
+    def get_tz_info(tz_name):
         seconds_in_day = 24 * 60 * 60
-        tz = lookup_timezone_by_name(tz)
+        tz = lookup_timezone_by_name(tz_name)
         time_conv = time.astimezone(tz)
         seconds_in_hour = 60 * 60
         offset_hrs = time_conv.utcoffset().total_seconds() / seconds_in_hour
@@ -142,7 +405,7 @@ def localize_time_by_each_tz(time, tz_areas):
         else:
             is_dst = int(before_transition)
 
-        timezone_experiences_dst = get_timezone_experiences_dst(tz, time_naive.year)
+        timezone_experiences_dst = get_timezone_experiences_dst(tz_name, time_naive.year)
 
         assert -35 <= transition_offset_days <= 35, f'{transition_offset_days=} out of range'
         assert -24 <= offset_hrs <= 24
@@ -170,30 +433,17 @@ def localize_time_by_each_tz(time, tz_areas):
         timezone_experiences_dst = df['timezone_experiences_dst'].iloc[0]
     else:
         # Slow path
-        # Round area so that the total sum is preserved
-        area = pd.Series(iteround.saferound(df['area'].to_dict(), places=0, strategy='difference'))
-        # Constant controlling how many times to duplicate each percentage
-        # of area. Higher values make a better approximation of statistical
-        # aggregates, but at the cost of compute time
-        number_copies_per_percent = 1
-        area = (area * number_copies_per_percent).round().astype(int)
-        df['area'] = area
-        if df['area'].sum() != 100 * number_copies_per_percent:
-            breakpoint()
-        # Repeat row as many times as appears in area
-        df = df.loc[df.index.repeat(df['area'])]
-        assert len(df) == 100 * number_copies_per_percent, \
-            f'df had {len(df)} rows, should be {100 * number_copies_per_percent}'
-        offset = df['offset'].values
-        lower, upper = np.quantile(offset, q=[0.025, 0.975])
-        point_estimate = offset.mean()
-        # Ensure that the point estimate always lies within the range [lower, upper]
-        point_estimate = min(max(lower, point_estimate), upper)
+        counts = get_area_counts(df['area']).values
+        lower, point_estimate, upper, is_dst, days_since_transition, timezone_experiences_dst = (
+            stat[0] for stat in summarize_multiple_tz(
+                df[['offset']].values.T,
+                df[['dst']].values.T,
+                df[['days_since_transition']].values.T,
+                df[['timezone_experiences_dst']].values.T,
+                counts,
+            )
+        )
         assert lower <= point_estimate <= upper
-        is_dst = df['dst'].mean()
-        # Get the most common number of days since transition
-        days_since_transition = df['days_since_transition'].mode().iloc[0]
-        timezone_experiences_dst = df['timezone_experiences_dst'].mean()
     assert isinstance(lower, Number)
     assert isinstance(point_estimate, Number)
     assert isinstance(upper, Number)
@@ -203,10 +453,140 @@ def localize_time_by_each_tz(time, tz_areas):
     return lower, point_estimate, upper, is_dst, days_since_transition, timezone_experiences_dst
 
 
+TWITTER_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def get_tz_info_vectorized(time_utc, tz_names):
+    """Vectorized version of get_tz_info() in localize_time_by_each_tz().
+
+    time_utc is a UTC-aware datetime Series, and tz_names is an array of
+    timezone names of the same length. Returns a DataFrame with the columns
+    offset, dst, days_since_transition and timezone_experiences_dst."""
+    table = get_transition_table()
+    tz_names = np.asarray(tz_names)
+    seconds_in_day = 24 * 60 * 60
+    seconds_in_hour = 60 * 60
+    microseconds_in_second = 10 ** 6
+
+    # Convert to local time
+    time_utc = time_utc.dt.tz_convert('UTC').dt.tz_localize(None).values.astype('datetime64[us]')
+    time_utc_us = time_utc.astype(np.int64)
+    offset_us = table.utc_offset(tz_names, time_utc_us) * microseconds_in_second
+    time_naive_us = time_utc_us + offset_us
+    offset_hrs = offset_us / microseconds_in_second / seconds_in_hour
+
+    # Look up the transition for the year and season of each tweet
+    year = time_utc.astype('datetime64[Y]').astype(int) + 1970
+    spring = time_utc.astype('datetime64[M]').astype(int) % 12 + 1 <= 6
+    changeovers = np.array([
+        [epoch_us(get_dst_changeover_for_year(int(y), s)) for s in (True, False)]
+        for y in util.inclusive_range(table.start_year, table.end_year)
+    ], dtype=np.int64)
+    transition_us = changeovers[year - table.start_year, (~spring).astype(int)]
+    transition_offset_days = (time_naive_us - transition_us) / microseconds_in_second / seconds_in_day
+    before_transition = transition_offset_days <= 0
+    is_dst = np.where(spring, ~before_transition, before_transition).astype(int)
+
+    local_year = time_naive_us.astype('datetime64[us]').astype('datetime64[Y]').astype(int) + 1970
+    timezone_experiences_dst = table.experiences_dst(tz_names, local_year).astype(int)
+
+    assert ((-35 <= transition_offset_days) & (transition_offset_days <= 35)).all(), \
+        f'transition_offset_days out of range, have {transition_offset_days.min()=} {transition_offset_days.max()=}'
+    assert ((-24 <= offset_hrs) & (offset_hrs <= 24)).all()
+
+    return pd.DataFrame({
+        'offset': offset_hrs,
+        'dst': is_dst,
+        'days_since_transition': transition_offset_days,
+        'timezone_experiences_dst': timezone_experiences_dst,
+    })
+
+
 def get_tz_for_tweets(tweets):
     assert isinstance(tweets, pd.DataFrame)
     assert len(tweets) > 0, "Can't process zero-len tweet dataframe"
 
+    time_utc = pd.to_datetime(tweets['date'], format=TWITTER_TIMESTAMP_FORMAT, utc=True)
+    time_utc = time_utc.reset_index(drop=True)
+
+    # Find the timezone breakdown once per place, and expand it into one
+    # row per (tweet, candidate timezone) pair.
+    place_rows = tweets.reset_index(drop=True).groupby('place_id', sort=False).indices
+    place_bboxes = {
+        place_id: tuple(tweets[['minx', 'miny', 'maxx', 'maxy']].iloc[rows[0]])
+        for place_id, rows in place_rows.items()
+    }
+    areas_by_place = lookup_places_cached(place_bboxes)
+    place_areas = {}
+    candidate_row = []
+    candidate_tz = []
+    for place_id, rows in place_rows.items():
+        areas = areas_by_place[place_id]
+        place_areas[place_id] = (rows, areas)
+        for tz in areas.index:
+            candidate_row.append(rows)
+            candidate_tz.append(np.full(len(rows), tz, dtype=object))
+    candidate_row = np.concatenate(candidate_row)
+    candidate_tz = np.concatenate(candidate_tz)
+    info = get_tz_info_vectorized(time_utc.iloc[candidate_row], candidate_tz)
+
+    n = len(tweets)
+    most_probable_tz = np.empty(n, dtype=object)
+    lower = np.empty(n)
+    point_estimate = np.empty(n)
+    upper = np.empty(n)
+    is_dst = np.empty(n)
+    days_since_transition = np.empty(n)
+    timezone_experiences_dst = np.empty(n)
+    start = 0
+    for place_id, (rows, areas) in place_areas.items():
+        # Candidate rows for this place are laid out timezone by timezone
+        k = len(areas)
+        end = start + k * len(rows)
+        place_info = {
+            col: info[col].values[start:end].reshape(k, len(rows)).T
+            for col in info.columns
+        }
+        start = end
+        most_probable_tz[rows] = areas.index[0]
+        if k == 1:
+            # Only one timezone match
+            # Fast path
+            lower[rows] = place_info['offset'][:, 0]
+            point_estimate[rows] = place_info['offset'][:, 0]
+            upper[rows] = place_info['offset'][:, 0]
+            is_dst[rows] = place_info['dst'][:, 0]
+            days_since_transition[rows] = place_info['days_since_transition'][:, 0]
+            timezone_experiences_dst[rows] = place_info['timezone_experiences_dst'][:, 0]
+        else:
+            counts = get_area_counts(areas).values
+            lower[rows], point_estimate[rows], upper[rows], is_dst[rows], \
+                days_since_transition[rows], timezone_experiences_dst[rows] = summarize_multiple_tz(
+                    place_info['offset'],
+                    place_info['dst'],
+                    place_info['days_since_transition'],
+                    place_info['timezone_experiences_dst'],
+                    counts,
+                )
+    assert (lower <= point_estimate).all() and (point_estimate <= upper).all()
+
+    return pd.DataFrame({
+        'tweet_id': tweets['tweet_id'].values,
+        'most_probable_tz': most_probable_tz,
+        'local_legal_time_offset_ci_lower': lower,
+        'local_legal_time_offset_ci_point': point_estimate,
+        'local_legal_time_offset_ci_upper': upper,
+        'is_dst': is_dst,
+        'days_since_transition': days_since_transition,
+        'timezone_experiences_dst': timezone_experiences_dst,
+    }, index=tweets.index)
+
+
+def get_tz_for_tweets_rowwise(tweets):
+    """Reference implementation of get_tz_for_tweets(), one row at a time."""
+    assert isinstance(tweets, pd.DataFrame)
+    assert len(tweets) > 0, "Can't process zero-len tweet dataframe"
+
     def get_offset_summary(row):
         try:
             bbox = tuple(row[['minx', 'miny', 'maxx', 'maxy']])
@@ -267,8 +647,11 @@ def test_ri():
             con=con,
         )
     print(tz)
+    tz_rowwise = get_tz_for_tweets_rowwise(tz)
     tz = get_tz_for_tweets(tz)
     print(tz.to_string())
+    # Check that the vectorized path agrees with the row-by-row path
+    pd.testing.assert_frame_equal(tz, tz_rowwise, check_dtype=False)
     con.close()
 
 
@@ -0,0 +1,56 @@
+"""Derived time columns for each tweet, stored in the tweet_features table.
+
+These are the columns export_csv.DataSource.transform() derives from the
+tweet date and legal timezone offset, so exports and ad-hoc queries can
+read them instead of recomputing them. They are computed with the same
+time_features code as the export, so they match it exactly, including the
+weekday numbering of the installed polars version."""
+import time_features
+
+import polars as pl
+
+
+TRANSITION_WINDOWS = [
+    (7, 'within_1wk_transition'),
+    (14, 'within_2wk_transition'),
+    (21, 'within_3wk_transition'),
+    (28, 'within_4wk_transition'),
+]
+
+FEATURE_COLUMNS = [
+    'tweet_id',
+    'legal_datetime',
+    'legal_year',
+    'legal_month',
+    'legal_day',
+    'legal_hour',
+    'legal_minute',
+    'legal_second',
+    'legal_day_of_week',
+    'spring_fall_indicator',
+    *[col_name for days_limit, col_name in TRANSITION_WINDOWS],
+]
+
+
+def get_features(tweet_df):
+    """Compute features from a pandas DataFrame with tweet_id, date,
+    local_legal_time_offset_ci_point and days_since_transition.
+
+    Tweets without an offset are kept, with a NULL legal_datetime, rather
+    than being left out. An export with --from-features then drops the same
+    rows as one which derives the features."""
+    if len(tweet_df) == 0:
+        return tweet_df.iloc[:0].reindex(columns=FEATURE_COLUMNS)
+    tweet_df = pl.from_pandas(tweet_df.rename(columns={
+        'local_legal_time_offset_ci_point': 'legal_time_offset_ci_point',
+    }))
+    # Missing values can arrive as NaN, which polars doesn't treat as null
+    tweet_df = tweet_df.with_columns([
+        pl.when(pl.col(col).cast(pl.Float64).is_nan())
+        .then(None)
+        .otherwise(pl.col(col).cast(pl.Float64))
+        .alias(col)
+        for col in ['legal_time_offset_ci_point', 'days_since_transition']
+    ])
+    tweet_df = time_features.derive_features(tweet_df)
+    return tweet_df[FEATURE_COLUMNS].to_pandas()
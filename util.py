@@ -180,6 +180,11 @@ def chunks(lst, n):
         yield lst[i:i + n]
 
 
+def get_config():
+    """Load project configuration from config.json."""
+    return json.load(open('config.json', 'rb'))
+
+
 def create_engine():
     """Create SQLAlchemy engine from project and myloginpath configuration."""
     url = create_url()